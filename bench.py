@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""
+Benchmark for the papercut WordPress storage backend
+
+Builds a synthetic WordPress database (wp_users, wp_posts, wp_comments)
+in a local MySQL/MariaDB server, then times the Papercut_Storage commands
+against it and prints the results as JSON, so two runs (e.g. before and
+after a change) can be compared:
+
+  python bench.py --papercut-dir /usr/share/papercut --user bench \\
+      --posts 1000 --comments 100000 --depth 4 --output before.json
+
+The database named by --database is dropped and recreated unless --keep is
+given, in which case the existing data is reused and only the newsgroup
+tables are reset.  Queries are counted per command by wrapping the MySQLdb
+cursors.  Memory is reported twice: rss_delta_kb is the change in current
+resident size over a command's runs (read from /proc, so Linux only), and
+process_peak_rss_kb is the process-wide high-water mark (ru_maxrss) after
+them, which only moves when a command raises the peak of the whole run.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+import MySQLdb
+import MySQLdb.cursors
+
+GROUP = 'bench.wordpress'
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua ut enim '
+         'ad minim veniam quis nostrud exercitation ullamco laboris nisi ut '
+         'aliquip ex ea commodo consequat').split()
+
+class QueryCounter:
+    """Counts the statements run through any MySQLdb cursor."""
+
+    def __init__(self):
+        self.queries = 0
+        self.depth = 0
+
+    def install(self):
+        base = MySQLdb.cursors.BaseCursor
+        base.execute = self.wrap(base.execute)
+        base.executemany = self.wrap(base.executemany)
+
+    def wrap(self, original):
+        counter = self
+        def counted(cursor, *args, **kwargs):
+            # executemany may fall back to execute; count the outer call only
+            counter.depth += 1
+            try:
+                if counter.depth == 1:
+                    counter.queries += 1
+                return original(cursor, *args, **kwargs)
+            finally:
+                counter.depth -= 1
+        return counted
+
+counter = QueryCounter()
+
+def text(rand, words):
+    return ' '.join([rand.choice(WORDS) for i in range(words)])
+
+def html(rand, size):
+    paragraphs = []
+    while sum([len(p) for p in paragraphs]) < size:
+        paragraphs.append('<p>%s.</p>' % (text(rand, 40),))
+    return '\n\n'.join(paragraphs)
+
+def connect(options, db=None):
+    kwargs = {'host': options.host, 'user': options.user, 'passwd': options.password,
+              'charset': 'utf8', 'use_unicode': True}
+    if db:
+        kwargs['db'] = db
+    return MySQLdb.connect(**kwargs)
+
+def create_dataset(options):
+    """Creates the database and fills it with users, posts and comments."""
+    rand = random.Random(options.seed)
+    conn = connect(options)
+    cursor = conn.cursor()
+    cursor.execute("DROP DATABASE IF EXISTS %s" % (options.database,))
+    cursor.execute("CREATE DATABASE %s CHARACTER SET utf8" % (options.database,))
+    cursor.execute("USE %s" % (options.database,))
+    cursor.execute("""CREATE TABLE wp_users(
+                      ID BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                      user_login VARCHAR(60) NOT NULL DEFAULT '',
+                      user_email VARCHAR(100) NOT NULL DEFAULT '',
+                      display_name VARCHAR(250) NOT NULL DEFAULT ''
+                      )""")
+    cursor.execute("""CREATE TABLE wp_posts(
+                      ID BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                      post_author BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                      post_date_gmt DATETIME NOT NULL,
+                      post_content LONGTEXT NOT NULL,
+                      post_title TEXT NOT NULL,
+                      post_status VARCHAR(20) NOT NULL DEFAULT 'publish',
+                      post_modified_gmt DATETIME NOT NULL,
+                      post_parent BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                      post_type VARCHAR(20) NOT NULL DEFAULT 'post',
+                      INDEX type_status_date (post_type, post_status, post_date_gmt, ID),
+                      INDEX post_author (post_author)
+                      )""")
+    cursor.execute("""CREATE TABLE wp_comments(
+                      comment_ID BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                      comment_post_ID BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                      comment_author TINYTEXT NOT NULL,
+                      comment_author_email VARCHAR(100) NOT NULL DEFAULT '',
+                      comment_date_gmt DATETIME NOT NULL,
+                      comment_content TEXT NOT NULL,
+                      comment_approved VARCHAR(20) NOT NULL DEFAULT '1',
+                      comment_parent BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                      user_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                      INDEX comment_post_ID (comment_post_ID),
+                      INDEX comment_approved_date_gmt (comment_approved, comment_date_gmt),
+                      INDEX comment_parent (comment_parent)
+                      )""")
+    cursor.executemany("INSERT INTO wp_users (ID, user_login, user_email, display_name) VALUES (%s, %s, %s, %s)",
+                       [(i, 'user%d' % i, 'user%d@example.com' % i, 'User %d' % i) for i in range(1, options.users + 1)])
+    now = int(time.time())
+    start = now - options.days * 86400
+    post_dates = sorted([rand.randint(start, now) for i in range(options.posts)])
+    rows = []
+    for i, date in enumerate(post_dates):
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(date))
+        rows.append((i + 1, rand.randint(1, options.users), stamp, html(rand, options.body_bytes),
+                     text(rand, 6).capitalize(), stamp))
+    insert_batches(cursor, """INSERT INTO wp_posts (ID, post_author, post_date_gmt, post_content, post_title, post_modified_gmt)
+                              VALUES (%s, %s, %s, %s, %s, %s)""", rows)
+    # replies pick a parent among the earlier comments of the same post that
+    # are less than depth levels deep
+    threads = {}
+    rows = []
+    for i in range(options.comments):
+        comment_id = i + 1
+        post = rand.randint(1, options.posts)
+        candidates = [c for c in threads.get(post, ())[-20:] if c[1] < options.depth]
+        parent, level = 0, 1
+        if candidates and rand.random() < 0.6:
+            parent, parent_level = rand.choice(candidates)
+            level = parent_level + 1
+        threads.setdefault(post, []).append((comment_id, level))
+        date = rand.randint(post_dates[post - 1], now)
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(date))
+        user = rand.random() < 0.3 and rand.randint(1, options.users) or 0
+        rows.append((comment_id, post, 'Guest %d' % (comment_id % 997,), 'guest%d@example.org' % (comment_id % 997,),
+                     stamp, html(rand, options.comment_bytes), parent, user))
+        if len(rows) >= 1000:
+            insert_comments(cursor, rows)
+            rows = []
+    insert_comments(cursor, rows)
+    conn.commit()
+    conn.close()
+
+def insert_comments(cursor, rows):
+    insert_batches(cursor, """INSERT INTO wp_comments (comment_ID, comment_post_ID, comment_author, comment_author_email,
+                                                       comment_date_gmt, comment_content, comment_parent, user_id)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""", rows)
+
+def insert_batches(cursor, stmt, rows):
+    for start in range(0, len(rows), 1000):
+        cursor.executemany(stmt, rows[start:start + 1000])
+
+def reset_newsgroup_tables(options):
+    conn = connect(options, options.database)
+    cursor = conn.cursor()
+    for table in ('wp_newsgroup_meta', 'wp_newsgroup_state', 'wp_newsgroup_overview',
+                  'wp_newsgroup_rendered', 'wp_newsgroup_search'):
+        cursor.execute("DROP TABLE IF EXISTS %s" % (table,))
+    conn.commit()
+    conn.close()
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = max(int(math.ceil(fraction * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+def peak_rss_kb():
+    """Process-wide high-water mark of the resident size, in kB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def current_rss_kb():
+    """Current resident size in kB, or None where /proc is missing."""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+def measure(name, call, runs, results):
+    """Runs call(i) runs times and records its timings under name."""
+    timings = []
+    queries = 0
+    rss_before = current_rss_kb()
+    for i in range(runs):
+        before = counter.queries
+        started = time.time()
+        call(i)
+        timings.append((time.time() - started) * 1000.0)
+        queries += counter.queries - before
+    timings.sort()
+    rss_after = current_rss_kb()
+    results[name] = {
+        'runs': runs,
+        'mean_ms': sum(timings) / len(timings),
+        'p50_ms': percentile(timings, 0.50),
+        'p90_ms': percentile(timings, 0.90),
+        'p99_ms': percentile(timings, 0.99),
+        'max_ms': timings[-1],
+        'queries_per_call': float(queries) / runs,
+        'rss_delta_kb': None if rss_before is None or rss_after is None else rss_after - rss_before,
+        'process_peak_rss_kb': peak_rss_kb(),
+    }
+    print('%-22s p50 %9.2f ms  p99 %9.2f ms  %6.1f queries' % (name, results[name]['p50_ms'], results[name]['p99_ms'],
+                                                              results[name]['queries_per_call']), file=sys.stderr)
+
+def configure(options):
+    """Points papercut's settings at the benchmark database and group;
+    call it before importing wordpress.
+    """
+    sys.path[:0] = [options.papercut_dir, os.path.join(options.papercut_dir, 'storage')]
+    import settings
+    settings.dbhost = options.host
+    settings.dbname = options.database
+    settings.dbuser = options.user
+    settings.dbpass = options.password
+    settings.wp_table_prefix = 'wp_'
+    settings.wp_newsgroups = {GROUP: {'prefix': 'wp_', 'description': 'Benchmark'}}
+    settings.wp_sync_in_background = False
+    if not getattr(settings, 'nntp_hostname', None):
+        settings.nntp_hostname = 'bench.example'
+    return settings
+
+def run(options):
+    configure(options)
+    import wordpress
+
+    counter.install()
+    results = {}
+    if not options.keep:
+        started = time.time()
+        create_dataset(options)
+        print('dataset created in %.1fs' % (time.time() - started,), file=sys.stderr)
+    reset_newsgroup_tables(options)
+
+    storages = []
+    measure('init_cold', lambda i: storages.append(wordpress.Papercut_Storage()), 1, results)
+    measure('init_warm', lambda i: storages.append(wordpress.Papercut_Storage()), options.iterations, results)
+    storage = storages[0]
+    # the schema check and first sync happen on first use, not in __init__
+    measure('sync_initial', lambda i: storage.update_newsgroup_meta(), 1, results)
+
+    total, low, high = storage.get_GROUP(GROUP)
+    rand = random.Random(options.seed)
+    # sample existing articles; low..high has gaps where rows were hidden
+    existing = storage.get_article_index(GROUP).numbers
+    if not existing:
+        raise SystemExit('group %s has no articles' % (GROUP,))
+    numbers = [rand.choice(existing) for i in range(options.iterations)]
+    message_ids = [storage.get_message_id(number, GROUP) for number in numbers]
+    partial_low = max(low, high - options.range + 1)
+    since = time.localtime(time.time() - options.newnews_days * 86400)
+
+    commands = [
+        ('GROUP', lambda i: storage.get_GROUP(GROUP)),
+        ('XOVER_full', lambda i: storage.get_XOVER(GROUP, low, high)),
+        ('XOVER_partial', lambda i: storage.get_XOVER(GROUP, partial_low, high)),
+        ('ARTICLE_number', lambda i: storage.get_ARTICLE(GROUP, numbers[i])),
+        ('ARTICLE_message_id', lambda i: storage.get_ARTICLE(GROUP, message_ids[i])),
+        ('XHDR_subject', lambda i: storage.get_XHDR(GROUP, 'Subject', 'range', (low, high))),
+        ('NEWNEWS', lambda i: storage.get_NEWNEWS(since, GROUP)),
+        ('LISTGROUP', lambda i: storage.get_LISTGROUP(GROUP)),
+    ]
+    for name, call in commands:
+        if options.commands and name not in options.commands:
+            continue
+        measure(name, call, options.iterations, results)
+
+    return {
+        'dataset': {'users': options.users, 'posts': options.posts, 'comments': options.comments,
+                    'depth': options.depth, 'days': options.days, 'body_bytes': options.body_bytes,
+                    'comment_bytes': options.comment_bytes, 'seed': options.seed,
+                    'articles': total, 'low': low, 'high': high, 'partial_range': options.range},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'mysql': MySQLdb.get_client_info(), 'started': options.started},
+        'commands': results,
+        'article_cache': wordpress.article_cache.stats(),
+        'pool': wordpress.pool.stats(),
+    }
+
+def add_dataset_arguments(parser):
+    """Adds the database and synthetic dataset options to parser."""
+    parser.add_argument('--papercut-dir', required=True, help='papercut checkout holding settings.py and storage/')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', default='papercut_bench', help='database to (re)create (default %(default)s)')
+    parser.add_argument('--keep', action='store_true', help='reuse the existing dataset')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=4, help='maximum reply depth of comment threads')
+    parser.add_argument('--days', type=int, default=365, help='period the posts are spread over')
+    parser.add_argument('--body-bytes', type=int, default=2000, help='approximate size of a post')
+    parser.add_argument('--comment-bytes', type=int, default=300, help='approximate size of a comment')
+    parser.add_argument('--seed', type=int, default=1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the papercut WordPress storage backend.')
+    add_dataset_arguments(parser)
+    parser.add_argument('--iterations', type=int, default=20, help='runs of each command')
+    parser.add_argument('--range', type=int, default=100, help='articles in the partial XOVER range')
+    parser.add_argument('--newnews-days', type=int, default=7, help='age of the NEWNEWS cut-off')
+    parser.add_argument('--commands', nargs='*', help='only run these commands (after init)')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    options = parser.parse_args()
+    options.started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    report = run(options)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output + '\n')
+        f.close()
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
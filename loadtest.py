@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+"""
+Load test for the papercut WordPress storage backend
+
+Replays traces of NNTP commands against Papercut_Storage from many
+concurrent sessions, to find where contention sets in: shared pool
+connections, the meta sync's INSERT ... SELECT against readers and
+connections being handed back and forth.  A trace holds one JSON line per
+command, {"session": ..., "command": "XOVER", "args": [...]}, as written
+by a server running with wp_trace_file set, or made up from the benchmark
+dataset (see bench.py) by the synthesize command:
+
+  python loadtest.py synthesize --papercut-dir /usr/share/papercut \\
+      --user bench --posts 1000 --comments 100000 --sessions 500 --output trace.json
+  python loadtest.py replay --papercut-dir /usr/share/papercut --user bench \\
+      --keep --trace trace.json --concurrency 1 2 4 8 16 32 --sync-interval 5 \\
+      --write-rate 20 --output load.json
+
+Each session of the trace runs on its own Papercut_Storage, as a client
+connection would, and hands its pooled connection back when it ends.
+Every concurrency level replays the whole trace (or loops over it for
+--duration seconds), either as fast as the sessions go or paced at --rate
+commands per second overall.  Latency is counted from when a command was
+due, so time spent queueing behind a saturated server shows up in it;
+service time is counted from when it started.  Throughput, latency
+percentiles, errors and the pool's waits and reconnects are printed per
+level as JSON.
+
+Replays run against the benchmark database and group unless --settings is
+given, in which case papercut's settings.py is used as it is (to replay a
+production trace against a copy of its database).
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+import MySQLdb
+
+import bench
+
+def load_trace(path):
+    """Returns the sessions of a trace, lists of (command, args, kwargs)
+    in the order they were run.
+    """
+    sessions = {}
+    order = []
+    f = open(path)
+    try:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry.get('args'), list):
+                continue
+            session = entry.get('session', 0)
+            if session not in sessions:
+                sessions[session] = []
+                order.append(session)
+            kwargs = dict([(str(name), value) for name, value in entry.get('kwargs', {}).items()])
+            sessions[session].append((entry['command'], entry['args'], kwargs))
+    finally:
+        f.close()
+    return [sessions[session] for session in order]
+
+def call_args(command, args):
+    """Turns JSON arguments back into what the command method expects."""
+    args = list(args)
+    if command == 'NEWNEWS' and args and isinstance(args[0], list):
+        args[0] = time.struct_time(args[0])
+    return args
+
+def synthesize(options, storage):
+    """Makes up sessions the way newsreaders behave: select the group,
+    fetch the overview of the newest articles, read some of them (mostly
+    recent ones), and now and then ask what is new.
+    """
+    rand = random.Random(options.seed)
+    total, low, high = storage.get_GROUP(bench.GROUP)
+    # numbering has gaps, so articles are picked among the existing numbers
+    numbers = list(storage.get_article_index(bench.GROUP).numbers)
+    entries = []
+    if len(numbers) == 0:
+        return entries
+    for session in range(1, options.sessions + 1):
+        commands = [('GROUP', [bench.GROUP])]
+        recent = rand.randint(1, options.range)
+        start = numbers[max(0, len(numbers) - recent)]
+        commands.append(('XOVER', [bench.GROUP, start, high]))
+        for i in range(rand.randint(1, options.articles)):
+            if rand.random() < 0.8:
+                number = rand.choice(numbers[-recent:])
+            else:
+                number = rand.choice(numbers)
+            if rand.random() < 0.2:
+                commands.append(('ARTICLE', [bench.GROUP, storage.get_message_id(number, bench.GROUP)]))
+            else:
+                commands.append((rand.choice(('ARTICLE', 'ARTICLE', 'HEAD', 'BODY')), [bench.GROUP, number]))
+        if rand.random() < options.newnews:
+            since = time.localtime(time.time() - rand.randint(1, options.newnews_days) * 86400)
+            commands.append(('NEWNEWS', [tuple(since), bench.GROUP]))
+        for command, args in commands:
+            entries.append({'session': session, 'command': command, 'args': args, 'kwargs': {}})
+    return entries
+
+class Pacer:
+    """Hands out the times commands are due at, rate per second overall
+    (now, if rate is 0).
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.time()
+        self.issued = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        if not self.rate:
+            return time.time()
+        self.lock.acquire()
+        try:
+            due = self.started + self.issued / float(self.rate)
+            self.issued += 1
+        finally:
+            self.lock.release()
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        return due
+
+class Level:
+    """One concurrency level of a replay and its results."""
+
+    def __init__(self, wordpress, sessions, concurrency, rate, duration, release):
+        self.wordpress = wordpress
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.duration = duration
+        self.release = release
+        self.pacer = Pacer(rate)
+        self.lock = threading.Lock()
+        self.next_session = 0
+        self.sessions_run = 0
+        self.latencies = []
+        self.service = []
+        self.commands = {}
+        self.errors = {}
+
+    def take_session(self):
+        self.lock.acquire()
+        try:
+            if self.duration:
+                if time.time() - self.pacer.started >= self.duration:
+                    return None
+            elif self.next_session >= len(self.sessions):
+                return None
+            session = self.sessions[self.next_session % len(self.sessions)]
+            self.next_session += 1
+            return session
+        finally:
+            self.lock.release()
+
+    def worker(self):
+        while True:
+            session = self.take_session()
+            if session is None:
+                return
+            storage = self.wordpress.Papercut_Storage()
+            for command, args, kwargs in session:
+                due = self.pacer.next()
+                started = time.time()
+                error = None
+                try:
+                    getattr(storage, 'get_' + command)(*call_args(command, args), **kwargs)
+                except Exception as e:
+                    error = '%s: %s' % (e.__class__.__name__, str(e)[:80])
+                finished = time.time()
+                self.record(command, (finished - due) * 1000.0, (finished - started) * 1000.0, error)
+            if self.release:
+                storage.release()
+            self.lock.acquire()
+            self.sessions_run += 1
+            self.lock.release()
+
+    def record(self, command, latency, service, error):
+        self.lock.acquire()
+        try:
+            self.latencies.append(latency)
+            self.service.append(service)
+            figures = self.commands.setdefault(command, {'latencies': [], 'errors': 0})
+            figures['latencies'].append(latency)
+            if error is not None:
+                figures['errors'] += 1
+                self.errors[error] = self.errors.get(error, 0) + 1
+        finally:
+            self.lock.release()
+
+    def run(self):
+        pool_before = self.wordpress.pool.stats()
+        threads = [threading.Thread(target=self.worker) for i in range(self.concurrency)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        pool_after = self.wordpress.pool.stats()
+        pool = dict(pool_after)
+        for name in ('created', 'waits', 'reconnects'):
+            pool[name] = pool_after[name] - pool_before[name]
+        count = len(self.latencies)
+        return {
+            'concurrency': self.concurrency,
+            'rate': self.pacer.rate,
+            'seconds': elapsed,
+            'sessions': self.sessions_run,
+            'commands': count,
+            'throughput': elapsed and count / elapsed or 0.0,
+            'error_count': sum(self.errors.values()),
+            'errors': self.errors,
+            'latency_ms': summary(self.latencies),
+            'service_ms': summary(self.service),
+            'per_command': dict([(command, dict(summary(figures['latencies']), errors=figures['errors']))
+                                 for command, figures in self.commands.items()]),
+            'pool': pool,
+            'sync': self.wordpress.scheduler.stats(),
+        }
+
+def summary(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {'count': 0}
+    return {'count': len(timings), 'mean': sum(timings) / len(timings),
+            'p50': bench.percentile(timings, 0.50), 'p90': bench.percentile(timings, 0.90),
+            'p99': bench.percentile(timings, 0.99), 'p999': bench.percentile(timings, 0.999),
+            'max': timings[-1]}
+
+class CommentWriter:
+    """Inserts comments at rate per second from its own connection, as a
+    busy blog would, so the syncs have rows to number while readers run.
+    """
+
+    def __init__(self, options, rate):
+        self.options = options
+        self.rate = rate
+        self.stopped = threading.Event()
+        self.written = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+
+    def run(self):
+        rand = random.Random(self.options.seed)
+        conn = bench.connect(self.options, self.options.database)
+        conn.autocommit(True)
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(ID) FROM wp_posts WHERE post_type='post' AND post_status='publish'")
+        posts = cursor.fetchone()[0] or 0
+        while posts and not self.stopped.wait(1.0 / self.rate):
+            try:
+                cursor.execute("""INSERT INTO wp_comments (comment_post_ID, comment_author, comment_author_email,
+                                                          comment_date_gmt, comment_content)
+                                  VALUES (%s, %s, %s, UTC_TIMESTAMP(), %s)""",
+                               (rand.randint(1, posts), 'Load test', 'load@example.org',
+                                bench.html(rand, self.options.comment_bytes)))
+                self.written += 1
+            except MySQLdb.Error:
+                self.errors += 1
+        conn.close()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def setup(options):
+    """Configures papercut for the run and imports the backend."""
+    if options.settings:
+        sys.path[:0] = [options.papercut_dir, os.path.join(options.papercut_dir, 'storage')]
+        import settings
+    else:
+        settings = bench.configure(options)
+        if not options.keep:
+            started = time.time()
+            bench.create_dataset(options)
+            print('dataset created in %.1fs' % (time.time() - started,), file=sys.stderr)
+    # the pool papercut would run with, unless asked for another size
+    if options.pool_size:
+        settings.wp_pool_size = options.pool_size
+    settings.wp_pool_timeout = options.pool_timeout
+    if options.sync_interval:
+        settings.wp_sync_in_background = True
+        settings.wp_sync_interval = options.sync_interval
+        settings.wp_sync_debounce = min(options.sync_interval, getattr(settings, 'wp_sync_debounce', 5))
+    import wordpress
+    return wordpress
+
+def run_synthesize(options):
+    options.settings = False
+    options.sync_interval = 0
+    options.pool_size = None
+    options.pool_timeout = 30
+    wordpress = setup(options)
+    storage = wordpress.Papercut_Storage()
+    storage.update_newsgroup_meta()
+    entries = synthesize(options, storage)
+    f = options.output and open(options.output, 'w') or sys.stdout
+    for entry in entries:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+    if options.output:
+        f.close()
+    print('%d commands in %d sessions' % (len(entries), options.sessions), file=sys.stderr)
+
+def run_replay(options):
+    sessions = load_trace(options.trace)
+    wordpress = setup(options)
+    # number everything up front so the first level does not pay for it
+    wordpress.Papercut_Storage().update_newsgroup_meta()
+    writer = None
+    if options.write_rate:
+        writer = CommentWriter(options, options.write_rate)
+        writer.start()
+    levels = []
+    try:
+        for concurrency in options.concurrency:
+            level = Level(wordpress, sessions, concurrency, options.rate, options.duration, options.release)
+            result = level.run()
+            levels.append(result)
+            print('concurrency %4d  %8.1f cmd/s  p50 %8.2f ms  p99 %8.2f ms  errors %d  waits %d  reconnects %d' %
+                  (concurrency, result['throughput'], result['latency_ms'].get('p50') or 0,
+                   result['latency_ms'].get('p99') or 0, result['error_count'],
+                   result['pool']['waits'], result['pool']['reconnects']), file=sys.stderr)
+    finally:
+        if writer is not None:
+            writer.stop()
+    return {
+        'trace': {'path': options.trace, 'sessions': len(sessions),
+                  'commands': sum([len(session) for session in sessions])},
+        'options': {'rate': options.rate, 'duration': options.duration,
+                    'sync_interval': options.sync_interval, 'write_rate': options.write_rate,
+                    'pool_size': wordpress.pool.size, 'release': options.release},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'mysql': MySQLdb.get_client_info(), 'started': options.started},
+        'levels': levels,
+        'comments_written': writer and writer.written or 0,
+        'article_cache': wordpress.article_cache.stats(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the papercut WordPress storage backend.')
+    commands = parser.add_subparsers(dest='command')
+    maker = commands.add_parser('synthesize', help='make up a trace from the benchmark dataset')
+    bench.add_dataset_arguments(maker)
+    maker.add_argument('--sessions', type=int, default=200, help='client sessions in the trace')
+    maker.add_argument('--range', type=int, default=200, help='most articles a session fetches the overview of')
+    maker.add_argument('--articles', type=int, default=10, help='most articles a session reads')
+    maker.add_argument('--newnews', type=float, default=0.2, help='share of sessions asking NEWNEWS')
+    maker.add_argument('--newnews-days', type=int, default=7, help='oldest NEWNEWS cut-off')
+    maker.add_argument('--output', help='write the trace here instead of stdout')
+    replay = commands.add_parser('replay', help='replay a trace at one or more concurrency levels')
+    bench.add_dataset_arguments(replay)
+    replay.add_argument('--trace', required=True, help='trace to replay, from synthesize or wp_trace_file')
+    replay.add_argument('--settings', action='store_true',
+                        help="use papercut's settings.py as it is instead of the benchmark database")
+    replay.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='concurrent sessions, one level each (default %(default)s)')
+    replay.add_argument('--rate', type=float, default=0, help='commands per second overall (default unpaced)')
+    replay.add_argument('--duration', type=float, default=0,
+                        help='seconds per level, looping over the trace (default one pass)')
+    replay.add_argument('--sync-interval', type=float, default=0,
+                        help='run the background sync this often during the replay (default off)')
+    replay.add_argument('--write-rate', type=float, default=0, help='comments inserted per second (default none)')
+    replay.add_argument('--pool-size', type=int, help="wp_pool_size (default the settings' own, 10 if unset)")
+    replay.add_argument('--pool-timeout', type=float, default=30, help='wp_pool_timeout')
+    replay.add_argument('--release', action='store_true',
+                        help='release the connection when a session ends, which papercut itself never does')
+    replay.add_argument('--output', help='write the JSON report here instead of stdout')
+    options = parser.parse_args()
+    options.started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    if options.command == 'synthesize':
+        run_synthesize(options)
+        return
+    report = run_replay(options)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output + '\n')
+        f.close()
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
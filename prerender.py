@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Bulk pre-render for the papercut WordPress storage backend
+
+Numbers any new posts and comments, renders every article body into
+wp_newsgroup_rendered on a pool of processes, then runs the regular sync
+so the overview is built from the stored bodies.  Run it once when
+pointing papercut at a blog with a long history (and again whenever
+convenient; articles already rendered are skipped):
+
+  python prerender.py --papercut-dir /usr/share/papercut --processes 8
+
+An interrupted run picks up where it stopped.  The timings and throughput
+are printed as JSON.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-render the article bodies of the papercut WordPress backend.')
+    parser.add_argument('--papercut-dir', required=True, help='papercut checkout holding settings.py and storage/')
+    parser.add_argument('--group', help='only pre-render this group')
+    parser.add_argument('--processes', type=int, help='rendering processes (default one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=500, help='articles read and rendered at a time')
+    parser.add_argument('--full', action='store_true', help='start over instead of resuming')
+    parser.add_argument('--no-sync', action='store_true', help='do not build the overview afterwards')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    sys.path[:0] = [options.papercut_dir, os.path.join(options.papercut_dir, 'storage')]
+    import wordpress
+
+    storage = wordpress.Papercut_Storage()
+    report = {}
+    started = time.time()
+    report['numbered'] = storage.update_newsgroup_meta(overview=False)
+    report['number_seconds'] = time.time() - started
+    report['prerender'] = storage.prerender(options.group, options.processes, options.chunk_size, options.full)
+    if not options.no_sync:
+        started = time.time()
+        storage.update_newsgroup_meta()
+        report['sync_seconds'] = time.time() - started
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
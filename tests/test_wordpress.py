@@ -0,0 +1,735 @@
+"""
+Tests of the papercut WordPress storage backend
+
+They need what wordpress.py imports: MySQLdb and papercut's settings,
+mime and strutil modules (the papercut directory on PYTHONPATH), but no
+database; statements go to a recording fake cursor.
+
+  PYTHONPATH=/usr/share/papercut python -m unittest discover tests
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MySQLdb
+import wordpress
+
+# failures the backend logs on purpose would otherwise clutter the output
+logging.getLogger('papercut.wordpress').addHandler(logging.NullHandler())
+logging.getLogger('papercut.wordpress').propagate = False
+
+class FakeCursor:
+    """Records statements; answers come from the responses list of
+    (statement fragment, rows) and failures from the failures dict of
+    statement fragment -> exception.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.responses = []
+        self.failures = {}
+        self.rows = []
+        self.lastrowid = 0
+        # (statement, rows) of every executemany()
+        self.batches = []
+
+    def execute(self, stmt, args=None):
+        stmt = ' '.join(stmt.split())
+        self.statements.append(stmt)
+        for fragment, error in self.failures.items():
+            if fragment in stmt:
+                raise error
+        self.rows = []
+        for fragment, rows in self.responses:
+            if fragment in stmt:
+                self.rows = list(rows)
+        if stmt.startswith('INSERT INTO'):
+            self.lastrowid += 1
+        return len(self.rows)
+
+    def executemany(self, stmt, rows):
+        self.statements.append(' '.join(stmt.split()))
+        self.batches.append((self.statements[-1], list(rows)))
+
+    def fetchone(self):
+        return self.rows and self.rows[0] or None
+
+    def fetchall(self):
+        return self.rows
+
+class FakeConnection:
+
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+        self.fail_commit = None
+
+    def commit(self):
+        if self.fail_commit is not None:
+            raise self.fail_commit
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+class Storage(wordpress.Papercut_Storage):
+    """A storage on the fake cursor serving the single group 'blog'."""
+
+    def __init__(self):
+        self.statements = {}
+        self.fake_cursor = FakeCursor()
+        self.fake_conn = FakeConnection()
+
+    def get_cursor(self):
+        return self.fake_cursor
+
+    def get_connection(self):
+        return self.fake_conn
+
+    def get_groups(self):
+        return {'blog': {'prefix': 'wp_', 'host': 'news.example', 'term_taxonomy_id': None,
+                         'description': 'Blog'}}
+
+    def get_article_meta(self, group_name, id):
+        # <post-7@...> is article 1 of the group
+        if id == '<post-7@news.example>':
+            return (1, 7, 'wp_posts', 'blog')
+        return None
+
+    def get_message_body(self, lines):
+        return lines.split('\n\n', 1)[1]
+
+    def update_article_indexes(self):
+        pass
+
+REPLY = ("From: Reader <reader@example.org>\n"
+         "Subject: Re: Hello\n"
+         "References: <post-7@news.example>\n"
+         "\n"
+         "A reply.\n")
+
+class PostTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        self.cursor = self.storage.fake_cursor
+        self.conn = self.storage.fake_conn
+        self.cursor.responses.append(("comment_status='open'", [(7,)]))
+
+    def tearDown(self):
+        if hasattr(wordpress.settings, 'wp_post_approved'):
+            del wordpress.settings.wp_post_approved
+
+    def test_reply_is_held_for_moderation(self):
+        self.assertEqual(self.storage.do_POST('blog', REPLY, '127.0.0.1'), 1)
+        self.assertEqual(self.conn.commits, 1)
+        self.assertFalse([stmt for stmt in self.cursor.statements if stmt.startswith('INSERT INTO wp_newsgroup_meta')])
+
+    def test_registration_required(self):
+        self.cursor.responses.append(("option_name=", [('1',)]))
+        self.assertEqual(self.storage.do_POST('blog', REPLY, '127.0.0.1'), None)
+        self.assertFalse([stmt for stmt in self.cursor.statements if stmt.startswith('INSERT')])
+
+    def test_reply_is_committed_with_its_meta_row(self):
+        wordpress.settings.wp_post_approved = '1'
+        self.assertEqual(self.storage.do_POST('blog', REPLY, '127.0.0.1'), 1)
+        self.assertEqual((self.conn.commits, self.conn.rollbacks), (1, 0))
+        meta = [stmt for stmt in self.cursor.statements if stmt.startswith('INSERT INTO wp_newsgroup_meta')]
+        self.assertEqual(len(meta), 1)
+        self.assertTrue('UNIX_TIMESTAMP(comment_date_gmt)' in meta[0])
+
+    def test_new_thread_is_rejected(self):
+        article = REPLY.replace("References: <post-7@news.example>\n", "")
+        self.assertEqual(self.storage.do_POST('blog', article, '127.0.0.1'), None)
+        self.assertFalse([stmt for stmt in self.cursor.statements if stmt.startswith('INSERT')])
+
+    def test_failed_post_rolls_back_to_its_savepoint_only(self):
+        calls = []
+        def insert_comment(group_name, post, ip_address):
+            calls.append(post)
+            if len(calls) == 1:
+                raise ValueError('bad post')
+            return 1
+        self.storage.insert_comment = insert_comment
+        results = self.storage.do_POST_batch([('blog', REPLY, '127.0.0.1', ''),
+                                              ('blog', REPLY, '127.0.0.1', '')])
+        self.assertEqual(results, [None, 1])
+        self.assertEqual(self.cursor.statements.count('ROLLBACK TO SAVEPOINT post'), 1)
+        self.assertEqual((self.conn.commits, self.conn.rollbacks), (1, 0))
+
+    def test_database_error_rolls_back_the_batch(self):
+        self.conn.fail_commit = MySQLdb.OperationalError(2013, 'Lost connection')
+        results = self.storage.do_POST_batch([('blog', REPLY, '127.0.0.1', '')] * 2)
+        self.assertEqual(results, [None, None])
+        self.assertEqual((self.conn.commits, self.conn.rollbacks), (0, 1))
+
+    def test_unexpected_error_rolls_back_and_propagates(self):
+        self.cursor.failures['SAVEPOINT'] = RuntimeError('boom')
+        self.assertRaises(RuntimeError, self.storage.do_POST_batch, [('blog', REPLY, '127.0.0.1', '')])
+        self.assertEqual((self.conn.commits, self.conn.rollbacks), (0, 1))
+
+def article_row(number, comment_id=0, comment_parent=0, parent_refs=None):
+    """A get_article_sql() row of a comment on post 7 of group 'blog'."""
+    row = [None] * 16
+    row[0], row[1], row[7], row[8] = number, comment_id, 7, comment_parent
+    row[9] = '<comment-%s@news.example>' % (comment_id,)
+    row[10] = '<post-7@news.example>'
+    if comment_parent:
+        row[11] = '<comment-%s@news.example>' % (comment_parent,)
+    row[13], row[14] = 'blog', parent_refs
+    return row
+
+class ReferencesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        self.cursor = self.storage.fake_cursor
+
+    def test_chain_comes_from_the_parent_overview_row(self):
+        row = article_row(5, 3, 2, '<post-7@news.example> <comment-1@news.example>')
+        self.assertEqual(self.storage.get_references(row),
+                         ['<post-7@news.example>', '<comment-1@news.example>', '<comment-2@news.example>'])
+        self.assertEqual(self.cursor.statements, [])
+
+    def test_chain_is_walked_when_the_parent_is_not_stored(self):
+        # comment 2 answers comment 1, which answers the post
+        answers = {2: (1, '<comment-1@news.example>'), 1: (0, None)}
+        def execute(stmt, args=None):
+            self.cursor.rows = [answers[args[1]]]
+            return 1
+        self.cursor.execute = execute
+        self.assertEqual(self.storage.get_references(article_row(5, 3, 2)),
+                         ['<post-7@news.example>', '<comment-1@news.example>', '<comment-2@news.example>'])
+
+    def test_batch_chain_wins_over_the_stored_one(self):
+        row = article_row(5, 3, 2, '<post-7@news.example>')
+        known = {'<comment-2@news.example>': '<post-7@news.example> <comment-1@news.example>'}
+        self.assertEqual(self.storage.get_references(row, known)[1], '<comment-1@news.example>')
+
+    def test_repair_runs_until_nothing_changes(self):
+        counts = [3, 1, 0, 5]
+        def execute(stmt, args=None):
+            self.cursor.statements.append(stmt)
+            return counts.pop(0)
+        self.cursor.execute = execute
+        self.storage.repair_references('blog')
+        self.assertEqual(len(self.cursor.statements), 3)
+
+class UnknownGroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        self.cursor = self.storage.fake_cursor
+        # the real lookup, not the fixed answer of Storage
+        self.storage.get_article_meta = self.get_article_meta
+
+    def get_article_meta(self, group_name, id):
+        return wordpress.Papercut_Storage.get_article_meta(self.storage, group_name, id)
+
+    def test_message_id_of_a_removed_group_is_no_such_article(self):
+        self.cursor.responses.append(('FROM wp_newsgroup_meta', [(3, 9, 'wp_posts', 'gone')]))
+        self.assertEqual(self.get_article_meta('gone', '<post-9@news.example>'), None)
+        self.assertEqual(self.storage.get_ARTICLE('gone', '<post-9@news.example>'), None)
+
+    def test_message_id_resolves_to_a_configured_group(self):
+        self.cursor.responses.append(('FROM wp_newsgroup_meta',
+                                      [(3, 9, 'wp_posts', 'gone'), (4, 9, 'wp_posts', 'blog')]))
+        self.assertEqual(self.get_article_meta('gone', '<post-9@news.example>'), (4, 9, 'wp_posts', 'blog'))
+
+    def test_number_in_a_removed_group_is_no_such_article(self):
+        self.assertEqual(self.get_article_meta('gone', 3), None)
+        self.assertEqual(self.cursor.statements, [])
+
+    def test_tables_of_a_removed_group_raise_no_such_group(self):
+        self.assertRaises(wordpress.NoSuchGroup, self.storage.get_table_name, 'gone', 'posts')
+        self.assertRaises(wordpress.NoSuchGroup, self.storage.get_category_filter, 'gone', 'ID')
+
+class HeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        self.storage.request_sync = lambda: None
+        self.queries = []
+        def stream_query(stmt, args=()):
+            self.queries.append(args)
+            yield [(1, 'Hello'), (2, 'Re: Hello')]
+        self.storage.stream_query = stream_query
+
+    def test_negated_character_class(self):
+        self.assertTrue(wordpress.wildmat('[^R]*', 'Hello'))
+        self.assertFalse(wordpress.wildmat('[^R]*', 'Re: Hello'))
+        self.assertFalse(wordpress.wildmat('*,![^R]*', 'Hello'))
+
+    def test_message_id_selects_that_article(self):
+        self.assertEqual(self.storage.get_XPAT('blog', 'Subject', 'H*', '<post-7@news.example>'), '1 Hello')
+        self.assertEqual(self.queries, [('blog', 1, 'H%', 1)])
+
+    def test_unknown_message_id_is_no_such_article(self):
+        self.assertEqual(self.storage.get_XPAT('blog', 'Subject', '*', '<post-8@news.example>'), None)
+        self.assertEqual(self.queries, [])
+
+    def test_xhdr_by_message_id(self):
+        self.assertEqual(self.storage.get_XHDR('blog', 'Subject', 'unique', ('<post-7@news.example>',)),
+                         '1 Hello\r\n2 Re: Hello')
+        self.assertEqual(self.queries, [('blog', 1, 1)])
+
+    def test_xhdr_by_unknown_message_id(self):
+        self.assertEqual(self.storage.get_XHDR('blog', 'Subject', 'unique', ('<post-8@news.example>',)), None)
+        self.assertEqual(self.queries, [])
+
+class ArticleExistsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        self.storage.request_sync = lambda: None
+        index = wordpress.ArticleIndex('blog', 'news.example')
+        for number in (1, 2, 3, 5):
+            index.add(number, number, 'wp_posts', '<post-%s@news.example>' % (number,))
+        self.storage.get_article_index = lambda group_name: index
+
+    def test_range_bounds_are_exclusive(self):
+        self.assertEqual(self.storage.article_exists('blog', 'range', (1, 5)), 2)
+        self.assertEqual(self.storage.article_exists('blog', 'range', (2,)), 2)
+
+    def test_single_article(self):
+        self.assertEqual(self.storage.article_exists('blog', 'id', (5,)), 1)
+        self.assertEqual(self.storage.article_exists('blog', 'id', (4,)), 0)
+
+class GMTDatetimeTest(unittest.TestCase):
+
+    def test_marks_are_compared_in_utc(self):
+        self.assertEqual(wordpress.gmt_datetime(86400 + 3661), '1970-01-02 01:01:01')
+
+class OverviewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        self.cursor = self.storage.fake_cursor
+
+    def stored(self):
+        return [rows for stmt, rows in self.cursor.batches if 'wp_newsgroup_overview' in stmt][0]
+
+    def test_author_without_user_row(self):
+        row = article_row(5, 3)
+        row[2], row[3] = 'Reader', None
+        self.assertEqual(self.storage.get_author(row), 'Reader')
+
+    def test_broken_row_does_not_stall_the_others(self):
+        def render_body(content):
+            if content == 'bad':
+                raise TypeError('cannot render')
+            return content + '\n'
+        self.storage.render_body = render_body
+        rows = [article_row(5, 3), article_row(6, 4)]
+        rows[0][6], rows[1][6] = 'bad', 'good'
+        rows[0][5] = rows[1][5] = 0
+        self.storage.store_overview(rows)
+        stored = self.stored()
+        self.assertEqual([value[0] for value in stored], [5, 6])
+        self.assertEqual(stored[0][7], 0)
+        self.assertEqual(stored[1][7], 5)
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = wordpress.ConnectionPool(1, 0.1, 60)
+        self.pool.connect = FakeConnection
+
+    def in_use(self):
+        return self.pool.stats()['in_use']
+
+    def test_connection_is_returned_after_the_command(self):
+        command = self.pool.command(lambda: self.pool.get())
+        first = command()
+        self.assertEqual(self.in_use(), 0)
+        self.assertTrue(command() is first)
+
+    def test_idle_sessions_share_one_connection(self):
+        command = self.pool.command(lambda: self.pool.get())
+        idle = threading.Event()
+        done = threading.Event()
+        def session():
+            command()
+            idle.set()
+            done.wait()
+        thread = threading.Thread(target=session)
+        thread.start()
+        try:
+            idle.wait()
+            # the other session is still connected, but between commands
+            command()
+        finally:
+            done.set()
+            thread.join()
+
+    def test_stream_keeps_the_connection_until_exhausted(self):
+        def rows():
+            self.pool.open_stream()
+            try:
+                self.pool.get()
+                yield 1
+                yield 2
+            finally:
+                self.pool.close_stream()
+        chunks = self.pool.command(rows)()
+        next(chunks)
+        self.assertEqual(self.in_use(), 1)
+        self.assertEqual(list(chunks), [2])
+        self.assertEqual(self.in_use(), 0)
+
+class InlineSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = wordpress.SyncScheduler(60, 5, 10)
+        self.syncs = []
+        self.storage = Storage()
+        self.storage.update_newsgroup_meta = lambda: self.syncs.append(1)
+
+    def test_burst_of_commands_syncs_once(self):
+        for i in range(3):
+            self.scheduler.run_inline(self.storage)
+        self.assertEqual(len(self.syncs), 1)
+
+    def test_failed_sync_is_retried(self):
+        def fail():
+            raise MySQLdb.OperationalError('gone away')
+        self.storage.update_newsgroup_meta = fail
+        self.assertRaises(MySQLdb.OperationalError, self.scheduler.run_inline, self.storage)
+        self.storage.update_newsgroup_meta = lambda: self.syncs.append(1)
+        self.scheduler.run_inline(self.storage)
+        self.assertEqual(len(self.syncs), 1)
+
+class ArticleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = wordpress.ArticleCache(10)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('a', 'A', 4)
+        self.cache.put('b', 'B', 4)
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.cache.put('c', 'C', 4)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.assertEqual(self.cache.get('c'), 'C')
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['evictions']), (2, 8, 1))
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+
+    def test_replacing_an_entry_keeps_the_size_right(self):
+        self.cache.put('a', 'A', 4)
+        self.cache.put('a', 'AA', 6)
+        self.assertEqual(self.cache.stats()['bytes'], 6)
+        self.assertEqual(self.cache.get('a'), 'AA')
+
+    def test_entry_larger_than_the_cache_is_not_kept(self):
+        self.cache.put('a', 'A', 4)
+        self.cache.put('big', 'B', 11)
+        self.assertEqual(self.cache.get('big'), None)
+        self.assertEqual(self.cache.get('a'), 'A')
+
+class GroupStatsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = wordpress.GroupStatsCache()
+        self.loads = []
+        self.storage = Storage()
+        def load_group_stats():
+            self.loads.append(1)
+            return {'blog': (len(self.loads), 1, len(self.loads))}
+        self.storage.load_group_stats = load_group_stats
+
+    def test_figures_are_kept_until_the_watermark_moves(self):
+        self.cache.check((5, 0))
+        self.assertEqual(self.cache.get(self.storage)['blog'][0], 1)
+        self.cache.check((5, 0))
+        self.assertEqual(self.cache.get(self.storage)['blog'][0], 1)
+        self.cache.check((6, 0))
+        self.assertEqual(self.cache.get(self.storage)['blog'][0], 2)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_figures_loaded_across_a_move_are_not_kept(self):
+        self.cache.check((5, 0))
+        def load_group_stats():
+            # a sync moved the watermark while this was loading
+            self.cache.check((6, 0))
+            self.loads.append(1)
+            return {'blog': (1, 1, 1)}
+        self.storage.load_group_stats = load_group_stats
+        self.cache.get(self.storage)
+        self.cache.get(self.storage)
+        self.assertEqual(len(self.loads), 2)
+
+class Clock:
+    """Stands in for the time module with a clock moved by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class LogRecords(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        wordpress.time = self.clock
+        self.log = LogRecords()
+        logging.getLogger('papercut.wordpress').addHandler(self.log)
+
+    def tearDown(self):
+        wordpress.time = time
+        logging.getLogger('papercut.wordpress').removeHandler(self.log)
+
+    def tick(self, seconds):
+        self.clock.now += seconds
+
+    def test_nested_phases_are_not_counted_twice(self):
+        record = wordpress.CommandRecord('XOVER')
+        self.tick(1)
+        record.enter('sql')
+        self.tick(2)
+        record.enter('render')
+        self.tick(1)
+        record.leave()
+        self.tick(2)
+        record.leave()
+        self.tick(1)
+        self.assertEqual(record.finish(), 7)
+        self.assertEqual(record.times, {'sync': 0, 'sql': 4, 'render': 1, 'format': 2})
+
+    def test_everything_during_the_sync_counts_as_sync(self):
+        record = wordpress.CommandRecord('GROUP')
+        record.enter('sync')
+        record.enter('sql')
+        self.tick(3)
+        record.leave()
+        record.leave()
+        record.finish()
+        self.assertEqual(record.times['sync'], 3)
+        self.assertEqual(record.times['sql'], 0)
+
+    def test_totals_and_slow_commands(self):
+        instrumentation = wordpress.Instrumentation(True, 2.0, 0)
+        for seconds, failed in ((1, False), (3, True)):
+            record = wordpress.CommandRecord('ARTICLE')
+            record.queries, record.rows, record.bytes = 2, 1, 100
+            self.tick(seconds)
+            instrumentation.finish(record, ('blog', 1), failed)
+        totals = instrumentation.stats()['ARTICLE']
+        self.assertEqual((totals['calls'], totals['errors'], totals['time'], totals['max_time']), (2, 1, 4, 3))
+        self.assertEqual((totals['queries'], totals['rows'], totals['bytes'], totals['format']), (4, 2, 200, 4))
+        self.assertEqual(len(self.log.records), 1)
+        self.assertTrue('"failed": true' in self.log.records[0].getMessage())
+
+class PrepareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        groups = self.storage.get_groups()
+        groups['other'] = dict(groups['blog'], prefix='wp_2_')
+        self.storage.get_groups = lambda: groups
+
+    def test_blog_tables_follow_the_group_prefix(self):
+        stmt = "SELECT * FROM wp_posts, wp_comments WHERE wp_posts.ID=%s"
+        self.assertEqual(self.storage.prepare(stmt, 'blog'), stmt)
+        self.assertEqual(self.storage.prepare(stmt, 'other'),
+                         "SELECT * FROM wp_2_posts, wp_2_comments WHERE wp_2_posts.ID=%s")
+
+    def test_shared_tables_keep_the_main_prefix(self):
+        stmt = "SELECT * FROM wp_newsgroup_meta M, wp_users U, wp_posts T"
+        self.assertEqual(self.storage.prepare(stmt, 'other'),
+                         "SELECT * FROM wp_newsgroup_meta M, wp_users U, wp_2_posts T")
+
+    def test_statements_are_rewritten_once_per_group(self):
+        stmt = "SELECT ID FROM wp_posts"
+        calls = []
+        substitute_tables = self.storage.substitute_tables
+        def counting(stmt, group_name=None):
+            calls.append(group_name)
+            return substitute_tables(stmt, group_name)
+        self.storage.substitute_tables = counting
+        for group_name in ('blog', 'other', 'blog', 'other'):
+            self.storage.prepare(stmt, group_name)
+        self.assertEqual(calls, ['blog', 'other'])
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage()
+        self.cursor = self.storage.fake_cursor
+        self.run = []
+        for name in wordpress.Papercut_Storage.migrations:
+            setattr(self.storage, name, lambda name=name: self.run.append(name))
+
+    def stored_versions(self):
+        return [rows[0][1] for stmt, rows in self.cursor.batches if 'wp_newsgroup_state' in stmt]
+
+    def test_new_database_runs_every_migration_in_order(self):
+        self.cursor.failures["name='schema_version'"] = MySQLdb.OperationalError(1146, "Table doesn't exist")
+        self.storage.migrate_schema()
+        self.assertEqual(self.run, wordpress.Papercut_Storage.migrations)
+        self.assertEqual(self.stored_versions(), [1, 2, 3, 4])
+
+    def test_only_newer_migrations_run(self):
+        self.cursor.responses.append(("name='schema_version'", [(2,)]))
+        self.storage.migrate_schema()
+        self.assertEqual(self.run, wordpress.Papercut_Storage.migrations[2:])
+        self.assertEqual(self.stored_versions(), [3, 4])
+        self.assertTrue('RELEASE_LOCK' in self.cursor.statements[-1])
+
+    def test_lock_is_released_when_a_migration_fails(self):
+        self.cursor.responses.append(("name='schema_version'", [(3,)]))
+        def fail():
+            raise MySQLdb.OperationalError(1050, 'Table already exists')
+        self.storage.create_search_table = fail
+        self.assertRaises(MySQLdb.OperationalError, self.storage.migrate_schema)
+        self.assertEqual(self.stored_versions(), [])
+        self.assertTrue('RELEASE_LOCK' in self.cursor.statements[-1])
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def test_failing_callback_does_not_kill_the_worker(self):
+        workers = wordpress.WorkerPool('test', 1)
+        first = workers.submit(lambda: 1)
+        first.add_done_callback(lambda future: 1 / 0)
+        self.assertEqual(first.result(5), 1)
+        second = workers.submit(lambda: 2)
+        second.add_done_callback(lambda future: 1 / 0)
+        self.assertEqual(second.result(5), 2)
+        self.assertEqual(workers.submit(lambda: 3).result(5), 3)
+        self.assertEqual(len([thread for thread in workers.threads if thread.is_alive()]), 1)
+
+    def test_dead_worker_is_replaced(self):
+        workers = wordpress.WorkerPool('test', 1)
+        self.assertEqual(workers.submit(lambda: 1).result(5), 1)
+        class Fatal:
+            def start(self):
+                # ends the worker thread quietly, as a fatal error would
+                raise SystemExit()
+        workers.queue.put((Fatal(), None, ()))
+        workers.threads[0].join(5)
+        self.assertFalse(workers.threads[0].is_alive())
+        self.assertEqual(workers.submit(lambda: 2).result(5), 2)
+
+    def test_error_reaches_the_future(self):
+        workers = wordpress.WorkerPool('test', 1)
+        self.assertRaises(ZeroDivisionError, workers.submit(lambda: 1 / 0).result, 5)
+
+class AsyncStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instrumentation = wordpress.instrumentation
+        wordpress.instrumentation = wordpress.Instrumentation(True, 60, 0)
+
+    def tearDown(self):
+        wordpress.instrumentation = self.instrumentation
+
+    def test_article_is_instrumented_as_one_command(self):
+        class Loaded:
+            def load_article(self, group_name, id):
+                return ('key', [None] * 16, u'Subject: x', None)
+            def format_article(self, article, headers_only, body_only):
+                return 'body'
+        storage = wordpress.AsyncStorage(Loaded())
+        self.assertEqual(storage.get_BODY('blog', 1).result(5), 'body')
+        # the done callbacks run right after the result is handed out
+        deadline = time.time() + 5
+        while 'BODY' not in wordpress.instrumentation.stats() and time.time() < deadline:
+            time.sleep(0.01)
+        stats = wordpress.instrumentation.stats()
+        self.assertEqual((stats['BODY']['calls'], stats['BODY']['errors'], stats['BODY']['bytes']), (1, 0, 4))
+
+class ArticleSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_articles_are_shared_between_spools(self):
+        writer = wordpress.ArticleSpool(self.path, 1 << 16)
+        reader = wordpress.ArticleSpool(self.path, 1 << 16)
+        self.assertEqual(reader.get(1), None)
+        writer.put(1, 10, u'Subject: caf\xe9', b'body\r\n')
+        self.assertEqual(reader.get(1), (u'Subject: caf\xe9', b'body\r\n'))
+        self.assertEqual(reader.get(1, 10), (u'Subject: caf\xe9', b'body\r\n'))
+        self.assertEqual(reader.get(1, 11), None)
+
+    def test_render_older_than_the_sync_is_not_served(self):
+        process = wordpress.ArticleSpool(self.path, 1 << 16)
+        sync = wordpress.ArticleSpool(self.path, 1 << 16)
+        process.put(1, 10, u'Subject: old', b'old')
+        # the sync renders the edited article, then a render of the old
+        # row started before the edit lands
+        sync.expect([(1, 11)])
+        process.put(1, 10, u'Subject: old', b'old')
+        self.assertEqual(sync.get(1), None)
+        self.assertEqual(process.get(1), None)
+        process.put(1, 11, u'Subject: new', b'new')
+        self.assertEqual(sync.get(1), (u'Subject: new', b'new'))
+
+    def test_full_spool_is_rotated(self):
+        writer = wordpress.ArticleSpool(self.path, 4096)
+        reader = wordpress.ArticleSpool(self.path, 4096)
+        writer.expect([(1, 11)])
+        writer.put(2, 20, u'Subject: two', b'two')
+        self.assertEqual(reader.get(2), (u'Subject: two', b'two'))
+        for number in range(100, 140):
+            writer.put(number, 0, u'Subject: filler', b'x' * 100)
+        self.assertTrue(writer.stats()['rotations'] > 0)
+        writer.put(2, 20, u'Subject: two', b'two')
+        self.assertEqual(reader.get(2), (u'Subject: two', b'two'))
+        self.assertEqual(reader.get(139), (u'Subject: filler', b'x' * 100))
+        # the version the sync recorded outlives the rotation
+        writer.put(1, 10, u'Subject: old', b'old')
+        self.assertEqual(reader.get(1), None)
+
+class SpooledArticleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = wordpress.spool
+        wordpress.spool = wordpress.ArticleSpool(os.path.join(self.directory, 'spool'), 1 << 16)
+        self.storage = Storage()
+        self.storage.get_article_meta = lambda group_name, id: (1, 7, 'wp_posts', 'blog')
+
+    def tearDown(self):
+        wordpress.spool = self.spool
+        shutil.rmtree(self.directory)
+
+    def test_current_version_is_served_from_the_spool(self):
+        wordpress.spool.put(1, 10, u'Subject: spooled', b'spooled')
+        self.storage.fake_cursor.responses.append(('SELECT UNIX_TIMESTAMP(post_modified_gmt) FROM', [(10,)]))
+        self.assertEqual(self.storage.get_BODY('blog', 1), b'spooled')
+        self.assertEqual(len(self.storage.fake_cursor.statements), 1)
+
+    def test_edited_article_is_loaded_again(self):
+        wordpress.spool.put(1, 10, u'Subject: spooled', b'spooled')
+        self.storage.fake_cursor.responses.append(('SELECT UNIX_TIMESTAMP(post_modified_gmt) FROM', [(11,)]))
+        self.assertEqual(self.storage.get_BODY('blog', 1), None)
+        self.assertTrue([stmt for stmt in self.storage.fake_cursor.statements if 'rendered_body' in stmt])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 # Licensed under the ISC License
 
 import MySQLdb
+import MySQLdb.cursors
 import time
 from mimify import mime_encode_header, mime_decode_header
 import re
@@ -9,11 +10,43 @@ import settings
 import mime
 import strutil
 import os.path
-
+import fnmatch
+import array
+import bisect
+import threading
+import logging
+import json
+import weakref
+import itertools
+import mmap
+import struct
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from email import message_from_string
+from email.utils import parseaddr
 try:
-    import html2text
+    import Queue as queue
 except ImportError:
-    html2text = None # Optional, GPL
+    import queue
+from collections import OrderedDict
+
+# html2text (optional, GPL) is imported when the first body is rendered
+html2text = None
+html2text_loaded = False
+
+def get_html2text():
+    """Returns the html2text module, or None if it is not installed."""
+    global html2text, html2text_loaded
+    if not html2text_loaded:
+        try:
+            import html2text as module
+            html2text = module
+        except ImportError:
+            html2text = None
+        html2text_loaded = True
+    return html2text
 
 # patch by Andreas Wegmann <Andreas.Wegmann@VSA.de> to fix the handling of unusual encodings of messages
 q_quote_multiline = re.compile("=\?(.*?)\?[qQ]\?(.*?)\?=.*?=\?\\1\?[qQ]\?(.*?)\?=", re.M | re.S)
@@ -24,6 +57,1268 @@ from_regexp = re.compile("^From:(.*)<(.*)>", re.M)
 subject_regexp = re.compile("^Subject:(.*)", re.M)
 references_regexp = re.compile("^References:(.*)<(.*)>", re.M)
 lines_regexp = re.compile("^Lines:(.*)", re.M)
+message_id_regexp = re.compile("^<(post|comment)-(\d+)@(.*)>$")
+# wp_ table names in statement templates, see Papercut_Storage.prepare()
+table_regexp = re.compile(r"\bwp_(\w+)")
+
+# prefix of the tables shared by every blog (and of the main blog)
+table_prefix = getattr(settings, 'wp_table_prefix', 'wp_')
+shared_tables = ('newsgroup_meta', 'newsgroup_state', 'newsgroup_overview', 'newsgroup_rendered', 'newsgroup_search', 'users', 'usermeta')
+
+# XHDR header name -> wp_newsgroup_overview column
+overview_columns = {
+    'SUBJECT': 'subject',
+    'FROM': 'author',
+    'DATE': 'date_header',
+    'MESSAGE-ID': 'message_id',
+    'REFERENCES': 'refs',
+    'BYTES': 'bytes',
+    'LINES': 'line_count',
+}
+# XOVER field order
+overview_fields = ('subject', 'author', 'date_header', 'message_id', 'refs', 'bytes', 'line_count')
+
+def gmt_datetime(timestamp):
+    """Formats a Unix timestamp as a UTC DATETIME, for the *_gmt columns."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+def wildmat(pattern, name):
+    """Matches name against an NNTP wildmat (comma separated, ! negates)."""
+    matched = False
+    for part in pattern.split(','):
+        # wildmat negates a character class with [^...], fnmatch with [!...]
+        if part.startswith('!'):
+            if fnmatch.fnmatchcase(name, part[1:].replace('[^', '[!')):
+                matched = False
+        elif fnmatch.fnmatchcase(name, part.replace('[^', '[!')):
+            matched = True
+    return matched
+
+def wildmat_like(pattern):
+    """Translates a single wildmat into a MySQL LIKE pattern, or returns
+    None when it uses something LIKE cannot express (character classes,
+    escapes, negation or a comma separated list).
+    """
+    if pattern.startswith('!') or [c for c in '[],\\' if c in pattern]:
+        return None
+    like = pattern.replace('%', '\\%').replace('_', '\\_')
+    return like.replace('*', '%').replace('?', '_')
+
+def render_html(content):
+    """Renders the HTML of a post or comment as an article body (a module
+    function so prerender() can run it in other processes).
+    """
+    if get_html2text():
+        return html2text.html2text(content.encode('utf-8').replace("\r\n", "\n").replace("\r", "\n").replace("\n\n", "</p><p>")).encode('utf-8')
+    else:
+        return strutil.format_body(content.encode('utf-8'))
+
+class ArticleCache:
+    """
+    Size bounded LRU cache of rendered articles
+
+    Entries are keyed by newsgroup, article number and content version, so
+    an edited post simply stops being hit and ages out.  The hits, misses
+    and evictions counters are there to help size wp_article_cache_size.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                void, (void, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size,
+                'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+article_cache = ArticleCache(getattr(settings, 'wp_article_cache_size', 16 * 1024 * 1024))
+
+class ArticleSpool:
+    """
+    Rendered articles shared by every papercut process on the host
+
+    An append-only file mapped by each process; see "Article spool:" in
+    the README for its layout.
+    """
+
+    header = struct.Struct('<8sQ')
+    record = struct.Struct('<4sQqII')
+    magic = b'WPSPOOL2'
+    closed = b'WPSPOOLX'
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fd = None
+        self.map = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.appended = 0
+        self.rotations = 0
+        self.reset()
+
+    def reset(self):
+        self.scanned = self.header.size
+        # article number -> (offset, headers size, body size, version)
+        self.index = {}
+        # article number -> version of its last VERS record
+        self.versions = {}
+
+    def enabled(self):
+        return self.path is not None and fcntl is not None
+
+    def open(self):
+        """Maps the spool, creating it if needed; on failure the spool is
+        logged and switched off for this process.
+        """
+        if self.fd is not None:
+            return True
+        try:
+            self.map_file()
+        except (OSError, IOError, ValueError):
+            log.exception('cannot use the article spool %s', self.path)
+            self.path = None
+            return False
+        return True
+
+    def map_file(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < self.header.size:
+                    os.ftruncate(fd, self.max_bytes)
+                    self.write_at(fd, 0, self.header.pack(self.magic, self.header.size))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            if self.header.unpack_from(self.map, 0)[0] not in (self.magic, self.closed):
+                self.map.close()
+                self.map = None
+                raise ValueError("%s is not an article spool" % (self.path,))
+        except:
+            os.close(fd)
+            raise
+        # another process may have created it with a different wp_spool_size
+        self.max_bytes = len(self.map)
+        self.fd = fd
+        self.reset()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+        self.map = None
+        self.fd = None
+
+    def write_at(self, fd, offset, data):
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+    def used(self):
+        return self.header.unpack_from(self.map, 0)[1]
+
+    def is_closed(self):
+        return self.header.unpack_from(self.map, 0)[0] == self.closed
+
+    def current(self):
+        """Maps the spool, moving on to a new file if it was rotated."""
+        if not self.open():
+            return False
+        if self.is_closed():
+            self.close()
+            if not self.open() or self.is_closed():
+                return False
+        return True
+
+    def refresh(self):
+        """Indexes the records appended since the last call."""
+        if self.used() == self.scanned:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            self.scan()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def scan(self):
+        # the caller holds the flock, shared or exclusive
+        used = self.used()
+        offset = self.scanned
+        while offset < used:
+            kind, number, version, headers_size, body_size = self.record.unpack_from(self.map, offset)
+            data = offset + self.record.size
+            if kind == b'VERS':
+                self.versions[number] = version
+                entry = self.index.get(number)
+                if entry is not None and entry[3] != version:
+                    del self.index[number]
+            elif self.versions.get(number, version) == version:
+                self.index[number] = (data, headers_size, body_size, version)
+            offset = data + headers_size + body_size
+        self.scanned = offset
+
+    def get(self, number, version=None):
+        """Returns (headers, body) of article number, or None; when version
+        is given, only if the spooled article has that version.
+        """
+        if not self.enabled():
+            return None
+        self.lock.acquire()
+        try:
+            if not self.current():
+                return None
+            self.refresh()
+            entry = self.index.get(number)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, headers_size, body_size, spooled = entry
+            if version is not None and spooled != version:
+                self.stale += 1
+                return None
+            self.hits += 1
+            headers = self.map[data:data + headers_size]
+            body = self.map[data + headers_size:data + headers_size + body_size]
+        finally:
+            self.lock.release()
+        return (headers.decode('utf-8'), body)
+
+    def put(self, number, version, headers, body):
+        if isinstance(body, type(u'')):
+            body = body.encode('utf-8')
+        self.append([(b'ARTI', number, version, headers.encode('utf-8'), body)])
+
+    def expect(self, versions):
+        """Records the (article number, version) pairs the sync rendered
+        again, so older renders are no longer served.
+        """
+        self.append([(b'VERS', number, version, b'', b'') for number, version in versions])
+
+    def append(self, records):
+        if not self.enabled() or len(records) == 0:
+            return
+        self.lock.acquire()
+        try:
+            if not self.current():
+                return
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.scan()
+                # a render older than the version the sync recorded is dropped
+                data = b''.join([self.pack(*record) for record in records
+                                 if record[0] == b'VERS' or self.versions.get(record[1], record[2]) == record[2]])
+                if self.used() + len(data) > self.max_bytes:
+                    carried = self.rotate()
+                    if carried is None:
+                        return
+                    data = carried + data
+                if self.used() + len(data) > self.max_bytes:
+                    log.warning('%s bytes do not fit into the article spool %s', len(data), self.path)
+                    return
+                if data:
+                    used = self.used()
+                    self.write_at(self.fd, used, data)
+                    self.write_at(self.fd, 0, self.header.pack(self.magic, used + len(data)))
+                    self.appended += len(records)
+            finally:
+                if self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            self.lock.release()
+
+    def pack(self, kind, number, version, headers, body):
+        return self.record.pack(kind, int(number), int(version), len(headers), len(body)) + headers + body
+
+    def rotate(self):
+        """Replaces the full spool, whose exclusive lock is held, with a new
+        one, locked in turn; returns the VERS records to carry over, or
+        None if no new spool could be started.
+        """
+        carried = b''.join([self.pack(b'VERS', number, version, b'', b'')
+                            for number, version in self.versions.items()])
+        self.write_at(self.fd, 0, self.header.pack(self.closed, self.used()))
+        try:
+            if os.stat(self.path).st_ino == os.fstat(self.fd).st_ino:
+                os.unlink(self.path)
+        except OSError:
+            pass
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.close()
+        self.rotations += 1
+        log.info('article spool %s rotated', self.path)
+        if not self.open():
+            return None
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.scan()
+        return carried
+
+    def stats(self):
+        return {'enabled': self.enabled(), 'entries': len(self.index),
+                'bytes': self.map is not None and self.used() or 0,
+                'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'stale': self.stale,
+                'appended': self.appended, 'rotations': self.rotations}
+
+spool = ArticleSpool(getattr(settings, 'wp_spool_file', None),
+                     getattr(settings, 'wp_spool_size', 256 * 1024 * 1024))
+
+class ArticleIndex:
+    """
+    In-memory copy of one newsgroup's article numbering
+
+    numbers holds the group's article numbers in ascending order, and ids
+    and tables the post or comment behind each one.  Message-IDs are looked
+    up through keys, a sorted array of (id << 1 | is_comment) with the
+    article numbers in key_numbers; rows added since the arrays were last
+    rebuilt sit in the recent dict.  Only Message-IDs that differ from the
+    usual <post-ID@host> form (e.g. after a hostname change) are kept as
+    strings.  Rows are only ever appended; update() reads the meta rows
+    numbered since the last call.
+    """
+
+    def __init__(self, group_name, host):
+        self.group_name = group_name
+        self.host = host
+        self.numbers = array.array('L')
+        self.ids = array.array('L')
+        self.tables = array.array('B')
+        self.table_names = []
+        self.keys = (array.array('L'), array.array('L'))
+        self.recent = {}
+        self.odd_message_ids = {}
+        self.odd_numbers = {}
+        self.seen = 0
+        self.lock = threading.Lock()
+
+    def update(self, storage, seen=None):
+        """Appends the meta rows numbered since the last update."""
+        self.lock.acquire()
+        try:
+            last = len(self.numbers) and self.numbers[-1] or 0
+            stmt = storage.prepare("""
+                    SELECT
+                        article_number, id, tbl, message_id
+                    FROM
+                        wp_newsgroup_meta
+                    WHERE
+                        newsgroup=%s AND article_number > %s
+                    ORDER BY
+                        article_number""")
+            for rows in storage.stream_query(stmt, (self.group_name, last)):
+                for number, id, tbl, message_id in rows:
+                    self.add(number, id, tbl, message_id)
+            if len(self.recent) > 4096:
+                self.merge()
+            if seen is not None:
+                self.seen = seen
+        finally:
+            self.lock.release()
+
+    def add(self, number, id, tbl, message_id):
+        if tbl not in self.table_names:
+            self.table_names.append(tbl)
+        kind = tbl.endswith('comments') and 1 or 0
+        # the parallel arrays grow before numbers so readers never see a
+        # number without its row
+        self.ids.append(id)
+        self.tables.append(self.table_names.index(tbl))
+        self.numbers.append(number)
+        if message_id == self.format_message_id(kind, id):
+            self.recent[id << 1 | kind] = number
+        else:
+            self.odd_message_ids[message_id] = number
+            self.odd_numbers[number] = message_id
+
+    def merge(self):
+        pairs = list(zip(self.keys[0], self.keys[1])) + list(self.recent.items())
+        pairs.sort()
+        self.keys = (array.array('L', [key for key, number in pairs]),
+                     array.array('L', [number for key, number in pairs]))
+        self.recent = {}
+
+    def format_message_id(self, kind, id):
+        return '<%s-%s@%s>' % (kind and 'comment' or 'post', id, self.host)
+
+    def position(self, number):
+        pos = bisect.bisect_left(self.numbers, number)
+        if pos < len(self.numbers) and self.numbers[pos] == number:
+            return pos
+        return None
+
+    def lookup(self, number):
+        """Returns (article_number, id, tbl, newsgroup) for a number."""
+        pos = self.position(int(number))
+        if pos is None:
+            return None
+        return (self.numbers[pos], self.ids[pos], self.table_names[self.tables[pos]], self.group_name)
+
+    def find(self, id, kind):
+        """Returns the article number of a post (kind 0) or comment (1)."""
+        key = id << 1 | kind
+        number = self.recent.get(key)
+        if number is not None:
+            return number
+        keys, key_numbers = self.keys
+        pos = bisect.bisect_left(keys, key)
+        if pos < len(keys) and keys[pos] == key:
+            return key_numbers[pos]
+        return None
+
+    def get_message_id(self, number):
+        pos = self.position(int(number))
+        if pos is None:
+            return None
+        if self.numbers[pos] in self.odd_numbers:
+            return self.odd_numbers[self.numbers[pos]]
+        kind = self.table_names[self.tables[pos]].endswith('comments') and 1 or 0
+        return self.format_message_id(kind, self.ids[pos])
+
+    def get_number(self, message_id):
+        """Returns the article number of a Message-ID in this group."""
+        if message_id in self.odd_message_ids:
+            return self.odd_message_ids[message_id]
+        match = message_id_regexp.match(message_id)
+        if match is None or match.group(3) != self.host:
+            return None
+        return self.find(int(match.group(2)), match.group(1) == 'comment' and 1 or 0)
+
+    def count(self, low, high=None):
+        start = bisect.bisect_left(self.numbers, low)
+        if high is None:
+            return len(self.numbers) - start
+        return bisect.bisect_right(self.numbers, high) - start
+
+    def first(self):
+        return len(self.numbers) and self.numbers[0] or 0
+
+    def previous(self, number):
+        pos = bisect.bisect_left(self.numbers, number)
+        if pos == 0:
+            return None
+        return self.numbers[pos - 1]
+
+    def next(self, number):
+        pos = bisect.bisect_right(self.numbers, number)
+        if pos == len(self.numbers):
+            return None
+        return self.numbers[pos]
+
+article_indexes = {}
+article_indexes_lock = threading.Lock()
+
+class GroupStatsCache:
+    """
+    Cached (total, low, high) of every group for GROUP and LIST
+
+    The figures stay valid until the meta watermark - the highest article
+    number and the count of removal passes - moves, which only happens
+    when a sync (in any process) adds or removes articles.  A miss reloads
+    every group with one aggregate query.
+    """
+
+    def __init__(self):
+        self.values = None
+        self.watermark = None
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, watermark):
+        """Drops the cached figures if the meta watermark has moved."""
+        if watermark != self.watermark:
+            self.values = None
+            self.watermark = watermark
+
+    def get(self, storage):
+        values = self.values
+        if values is not None:
+            self.hits += 1
+            return values
+        self.misses += 1
+        watermark = self.watermark
+        values = storage.load_group_stats()
+        if watermark == self.watermark:
+            self.values = values
+        return values
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': lookups and float(self.hits) / lookups or 0.0}
+
+group_stats = GroupStatsCache()
+
+class PostStats:
+    """
+    Counters of do_POST and do_POST_batch
+
+    A batch's time is spread evenly over its posts for the latency
+    figures; posts_per_second is throughput while ingesting.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.posted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.max_latency = 0.0
+
+    def record(self, posted, rejected, failed, elapsed):
+        self.lock.acquire()
+        try:
+            self.posted += posted
+            self.rejected += rejected
+            self.failed += failed
+            self.batches += 1
+            self.seconds += elapsed
+            count = posted + rejected + failed
+            if count:
+                self.max_latency = max(self.max_latency, elapsed / count)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        count = self.posted + self.rejected + self.failed
+        return {'posted': self.posted, 'rejected': self.rejected,
+                'failed': self.failed, 'batches': self.batches,
+                'seconds': self.seconds,
+                'mean_latency': count and self.seconds / count or 0.0,
+                'max_latency': self.max_latency,
+                'posts_per_second': self.seconds and self.posted / self.seconds or 0.0}
+
+post_stats = PostStats()
+
+class ConnectionPool:
+    """
+    Pool of MySQL connections handed out one per thread
+
+    A thread keeps the connection it checked out while it runs a command
+    (see command()) or reads a stream, so idle sessions hold none; one
+    checked out outside those is kept until release() or the thread
+    exits, and those of exited threads are taken back when the pool runs
+    short.  A connection that has not been
+    used for ping_interval seconds is pinged before it is handed out again
+    and replaced if the server has gone away (wait_timeout, restarts).
+    Connections run in autocommit mode so readers always see the latest
+    committed sync.
+    """
+
+    def __init__(self, size, timeout, ping_interval):
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.idle = []
+        self.owners = {}
+        self.local = threading.local()
+        self.lock = threading.Condition()
+        self.created = 0
+        self.waits = 0
+        self.reconnects = 0
+
+    def connect(self):
+        conn = MySQLdb.connect(host=settings.dbhost, db=settings.dbname, user=settings.dbuser, passwd=settings.dbpass, charset='utf8', use_unicode=True)
+        conn.autocommit(True)
+        return conn
+
+    def get(self):
+        """Returns the connection of the calling thread."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.checkout()
+        elif time.time() - self.local.last_used > self.ping_interval:
+            conn = self.check(conn)
+        self.local.last_used = time.time()
+        return conn
+
+    def cursor(self):
+        """Returns the default cursor of the calling thread's connection."""
+        conn = self.get()
+        if self.local.cursor is None:
+            self.local.cursor = conn.cursor()
+        return self.local.cursor
+
+    def checkout(self):
+        thread = threading.current_thread()
+        self.lock.acquire()
+        try:
+            deadline = None
+            while len(self.idle) == 0 and len(self.owners) >= self.size:
+                self.reclaim()
+                if len(self.idle) > 0 or len(self.owners) < self.size:
+                    break
+                if deadline is None:
+                    self.waits += 1
+                    deadline = time.time() + self.timeout
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise MySQLdb.OperationalError("connection pool exhausted (%s in use)" % (len(self.owners),))
+                # wake up now and then to take back connections of exited threads
+                self.lock.wait(min(remaining, 1.0))
+            if len(self.idle) > 0:
+                conn, last_used = self.idle.pop()
+            else:
+                conn, last_used = None, 0
+                self.created += 1
+            self.owners[thread] = conn
+        finally:
+            self.lock.release()
+        self.local.cursor = None
+        if conn is None:
+            try:
+                conn = self.connect()
+            except:
+                self.lock.acquire()
+                del self.owners[thread]
+                self.lock.notify()
+                self.lock.release()
+                raise
+            self.lock.acquire()
+            self.owners[thread] = conn
+            self.lock.release()
+        elif time.time() - last_used > self.ping_interval:
+            conn = self.check(conn)
+        self.local.conn = conn
+        return conn
+
+    def check(self, conn):
+        """Pings conn, reconnecting if the server has gone away."""
+        try:
+            conn.ping()
+            return conn
+        except MySQLdb.Error:
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
+        self.local.conn = None
+        self.local.cursor = None
+        thread = threading.current_thread()
+        try:
+            conn = self.connect()
+        except:
+            self.lock.acquire()
+            del self.owners[thread]
+            self.lock.notify()
+            self.lock.release()
+            raise
+        self.lock.acquire()
+        self.reconnects += 1
+        self.owners[thread] = conn
+        self.lock.release()
+        self.local.conn = conn
+        return conn
+
+    def reclaim(self):
+        """Takes back the connections of threads that have exited."""
+        for thread, conn in list(self.owners.items()):
+            if thread.is_alive():
+                continue
+            del self.owners[thread]
+            if conn is not None:
+                self.idle.append((conn, 0))
+
+    def command(self, method):
+        """Decorates a command method so the calling thread's connection
+        goes back to the pool when the outermost command returns.
+        """
+        pool = self
+        def wrapper(*args, **kwargs):
+            return pool.run(method, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def run(self, function, *args, **kwargs):
+        """Calls function as one command (see command())."""
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.local.depth -= 1
+            self.done()
+
+    def open_stream(self):
+        """Keeps the calling thread's connection until close_stream(), for
+        an unbuffered cursor read beyond the command that opened it.
+        """
+        self.local.streams = getattr(self.local, 'streams', 0) + 1
+
+    def close_stream(self):
+        self.local.streams -= 1
+        self.done()
+
+    def done(self):
+        if getattr(self.local, 'depth', 0) == 0 and getattr(self.local, 'streams', 0) == 0:
+            self.release()
+
+    def release(self):
+        """Returns the calling thread's connection to the pool."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+        self.local.conn = None
+        self.local.cursor = None
+        self.lock.acquire()
+        try:
+            del self.owners[threading.current_thread()]
+            self.idle.append((conn, time.time()))
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        in_use = len([thread for thread in self.owners.keys() if thread.is_alive()])
+        return {'size': self.size, 'in_use': in_use,
+                'idle': len(self.idle), 'created': self.created,
+                'waits': self.waits, 'reconnects': self.reconnects}
+
+pool = ConnectionPool(getattr(settings, 'wp_pool_size', 10),
+                      getattr(settings, 'wp_pool_timeout', 30),
+                      getattr(settings, 'wp_pool_ping_interval', 60))
+
+class SyncScheduler:
+    """
+    Background thread running the meta sync off the request path
+
+    The sync runs every interval seconds, and sooner when request() is
+    called, but never more often than once per debounce seconds, so a
+    burst of GROUP and XOVER commands costs one sync.  Request handlers
+    only read what the last sync committed; stats() reports how old that
+    is (lag) along with the duration and rows added of the last run.
+    Without the thread, run_inline() syncs on the calling thread at most
+    once per inline_interval seconds.
+    """
+
+    def __init__(self, interval, debounce, inline_interval=0):
+        self.interval = interval
+        self.debounce = debounce
+        self.inline_interval = inline_interval
+        self.last_inline = 0
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_run = 0
+        self.last_duration = 0
+        self.last_added = 0
+        self.last_error = None
+        self.runs = 0
+        self.errors = 0
+
+    def start(self, storage):
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(storage,))
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def request(self):
+        """Asks for a sync as soon as the debounce period allows."""
+        self.wakeup.set()
+
+    def run_inline(self, storage):
+        now = time.time()
+        if now - self.last_inline < self.inline_interval:
+            return
+        # set first, so commands arriving meanwhile do not sync as well
+        self.last_inline = now
+        try:
+            storage.update_newsgroup_meta()
+        except:
+            self.last_inline = 0
+            raise
+
+    def run(self, storage):
+        while True:
+            wait = self.last_run + self.debounce - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.wakeup.clear()
+            started = time.time()
+            try:
+                self.last_added = pool.run(storage.update_newsgroup_meta)
+                self.last_run = time.time()
+                self.last_error = None
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+            self.last_duration = time.time() - started
+            self.runs += 1
+            self.wakeup.wait(self.interval)
+
+    def stats(self):
+        return {'running': self.thread is not None,
+                'lag': self.last_run and time.time() - self.last_run or None,
+                'last_duration': self.last_duration,
+                'last_added': self.last_added, 'runs': self.runs,
+                'errors': self.errors, 'last_error': self.last_error}
+
+class GroupRegistry:
+    """
+    The newsgroups served and the WordPress tables behind each one
+
+    wp_newsgroups maps a group name per blog to its table prefix and
+    description; the blogs of a multisite install differ only in prefix.
+    With wp_category_groups each category of a blog is served as well, as
+    <blog group>.<category slug>, holding the posts filed under it and
+    their comments.  The group list is cached for ttl seconds.
+    """
+
+    def __init__(self, blogs, ttl):
+        self.blogs = blogs
+        self.ttl = ttl
+        self.groups = None
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def get(self, storage):
+        """Returns a dict of group name -> group."""
+        if self.groups is None or time.time() - self.loaded > self.ttl:
+            self.lock.acquire()
+            try:
+                if self.groups is None or time.time() - self.loaded > self.ttl:
+                    self.groups = self.load(storage)
+                    self.loaded = time.time()
+            finally:
+                self.lock.release()
+        return self.groups
+
+    def load(self, storage):
+        groups = {}
+        for name, blog in self.blogs.items():
+            prefix = blog.get('prefix', table_prefix)
+            if prefix == table_prefix:
+                host = settings.nntp_hostname
+            else:
+                # keep the Message-IDs of different blogs apart
+                host = '%s.%s' % (prefix.strip('_'), settings.nntp_hostname)
+            group = {'name': name, 'prefix': prefix,
+                     'description': blog.get('description', name),
+                     'host': blog.get('message_id_host', host),
+                     'term_taxonomy_id': None}
+            groups[name] = group
+            if not getattr(settings, 'wp_category_groups', False):
+                continue
+            stmt = """
+                    SELECT
+                        tt.term_taxonomy_id, t.slug, t.name
+                    FROM
+                        %sterm_taxonomy tt, %sterms t
+                    WHERE
+                        tt.term_id=t.term_id AND tt.taxonomy='category'""" % (prefix, prefix)
+            storage.cursor.execute(stmt)
+            for term_taxonomy_id, slug, description in storage.cursor.fetchall():
+                category = dict(group)
+                category['name'] = '%s.%s' % (name, slug)
+                category['description'] = description
+                category['term_taxonomy_id'] = term_taxonomy_id
+                groups[category['name']] = category
+        return groups
+
+groups = GroupRegistry(getattr(settings, 'wp_newsgroups', {'blog.singpolyma': {'prefix': table_prefix, 'description': 'Singpolyma'}}),
+                       getattr(settings, 'wp_group_cache_ttl', 300))
+
+scheduler = SyncScheduler(getattr(settings, 'wp_sync_interval', 60),
+                          getattr(settings, 'wp_sync_debounce', 5),
+                          getattr(settings, 'wp_inline_sync_interval', 2))
+
+class SchemaCheck:
+    """
+    Runs the schema migrations the first time a connection is used
+
+    Each process checks the stored schema_version once; threads arriving
+    while that runs wait for it, while the migrating thread itself gets
+    straight through to the connection.
+    """
+
+    def __init__(self):
+        self.checked = False
+        self.running = False
+        self.lock = threading.RLock()
+
+    def check(self, storage):
+        self.lock.acquire()
+        try:
+            if self.checked or self.running:
+                return
+            self.running = True
+            try:
+                storage.migrate_schema()
+                self.checked = True
+            finally:
+                self.running = False
+        finally:
+            self.lock.release()
+
+schema = SchemaCheck()
+
+log = logging.getLogger('papercut.wordpress')
+
+class CommandRecord:
+    """
+    Figures of one command as it runs
+
+    Time is charged to one phase at a time: entering a phase (sql,
+    render) pauses the one it was entered from, so nested phases are not
+    counted twice and format is whatever is left.  Everything done while
+    syncing, its statements and rendering included, counts as sync.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = self.since = time.time()
+        self.current = 'format'
+        self.stack = []
+        self.times = dict([(phase, 0.0) for phase in Instrumentation.phases])
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def enter(self, phase):
+        if self.current == 'sync':
+            phase = 'sync'
+        now = time.time()
+        self.times[self.current] += now - self.since
+        self.stack.append(self.current)
+        self.current = phase
+        self.since = now
+
+    def leave(self):
+        now = time.time()
+        self.times[self.current] += now - self.since
+        self.current = self.stack.pop()
+        self.since = now
+
+    def finish(self):
+        now = time.time()
+        self.times[self.current] += now - self.since
+        return now - self.started
+
+class InstrumentedCursor:
+    """Cursor wrapper charging statements and fetches to a CommandRecord."""
+
+    def __init__(self, cursor, record):
+        self.cursor = cursor
+        self.record = record
+
+    def execute(self, *args):
+        self.record.queries += 1
+        self.record.enter('sql')
+        try:
+            return self.cursor.execute(*args)
+        finally:
+            self.record.leave()
+
+    def executemany(self, *args):
+        self.record.queries += 1
+        self.record.enter('sql')
+        try:
+            return self.cursor.executemany(*args)
+        finally:
+            self.record.leave()
+
+    def fetchone(self):
+        self.record.enter('sql')
+        try:
+            row = self.cursor.fetchone()
+        finally:
+            self.record.leave()
+        if row is not None:
+            self.record.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        self.record.enter('sql')
+        try:
+            rows = self.cursor.fetchmany(*args)
+        finally:
+            self.record.leave()
+        self.record.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        self.record.enter('sql')
+        try:
+            rows = self.cursor.fetchall()
+        finally:
+            self.record.leave()
+        self.record.rows += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class CommandTrace:
+    """
+    Log of the read commands run, for replaying with loadtest.py
+
+    Each command a session runs (not the ones it runs on its own behalf,
+    like HEAD calling ARTICLE) is appended to the file as a JSON line with
+    its time since the trace was opened, a number per storage instance
+    (one per NNTP connection) and its arguments.  POST is never traced.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.started = time.time()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = weakref.WeakKeyDictionary()
+        # not len(sessions), which shrinks as storages are collected
+        self.session_numbers = itertools.count(1)
+
+    def command(self, method):
+        """Decorates a get_ command method."""
+        trace = self
+        name = method.__name__.split('_', 1)[1]
+        def wrapper(storage, *args, **kwargs):
+            if getattr(trace.local, 'active', False):
+                return method(storage, *args, **kwargs)
+            trace.write(storage, name, args, kwargs)
+            trace.local.active = True
+            try:
+                return method(storage, *args, **kwargs)
+            finally:
+                trace.local.active = False
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def write(self, storage, name, args, kwargs):
+        self.lock.acquire()
+        try:
+            session = self.sessions.get(storage)
+            if session is None:
+                session = self.sessions[storage] = next(self.session_numbers)
+            entry = {'t': round(time.time() - self.started, 6), 'session': session,
+                     'command': name, 'args': list(args), 'kwargs': kwargs}
+            try:
+                line = json.dumps(entry, sort_keys=True, default=self.encode)
+            except (TypeError, ValueError, UnicodeError):
+                # undecodable bytes; the entry is kept but cannot be replayed
+                entry['args'] = repr(args)
+                entry['kwargs'] = repr(kwargs)
+                line = json.dumps(entry, sort_keys=True)
+            self.file.write(line + "\n")
+            self.file.flush()
+        finally:
+            self.lock.release()
+
+    def encode(self, value):
+        # NEWNEWS is given a struct_time, which py2's json cannot encode
+        if isinstance(value, time.struct_time):
+            return tuple(value)
+        return str(value)
+
+class Instrumentation:
+    """
+    Timings and counters of the NNTP commands
+
+    When enabled, every command method records its wall time split into
+    the sync, sql and render phases and the rest (format), along with the
+    statements run, rows fetched and bytes returned.  Commands taking
+    slow_time seconds or more are logged as JSON to the papercut.wordpress
+    logger, stats() holds the running totals per command, and every
+    dump_interval seconds (if set) those are logged too.  When disabled
+    the methods are not wrapped at all, unless a CommandTrace is given.
+    """
+
+    phases = ('sync', 'sql', 'render', 'format')
+
+    def __init__(self, enabled, slow_time, dump_interval, trace=None):
+        self.enabled = enabled
+        self.trace = trace
+        self.slow_time = slow_time
+        self.dump_interval = dump_interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.last_dump = time.time()
+
+    def command(self, method):
+        """Decorates a command method (get_XOVER, do_POST, ...)."""
+        method = pool.command(method)
+        if self.trace is not None and method.__name__.startswith('get_'):
+            method = self.trace.command(method)
+        if not self.enabled:
+            return method
+        name = method.__name__.split('_', 1)[1]
+        instrumentation = self
+        def wrapper(storage, *args, **kwargs):
+            if getattr(instrumentation.local, 'record', None) is not None:
+                # HEAD, BODY, ... calling ARTICLE count as one command
+                return method(storage, *args, **kwargs)
+            record = CommandRecord(name)
+            instrumentation.local.record = record
+            failed = True
+            try:
+                result = method(storage, *args, **kwargs)
+                failed = False
+            finally:
+                instrumentation.local.record = None
+                if not failed:
+                    record.bytes = instrumentation.size(result)
+                instrumentation.finish(record, args, failed)
+            return result
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def begin(self, name, storage, args):
+        """Starts the record of a command whose work is spread over worker
+        threads (see AsyncStorage), or returns None when disabled.  Each
+        piece runs through call() and end() closes the record; time spent
+        waiting for a worker counts as format.
+        """
+        if self.trace is not None:
+            self.trace.write(storage, name, args, {})
+        if not self.enabled:
+            return None
+        return CommandRecord(name)
+
+    def call(self, record, function, *args):
+        """Runs function(*args) on this thread as part of record."""
+        if record is None:
+            return function(*args)
+        self.local.record = record
+        try:
+            return function(*args)
+        finally:
+            self.local.record = None
+
+    def end(self, record, args, future):
+        if record is None:
+            return
+        failed = future.cancelled() or future.error is not None
+        if not failed:
+            record.bytes = self.size(future.value)
+        self.finish(record, args, failed)
+
+    def phase(self, phase):
+        """Decorates a method whose time is charged to phase."""
+        instrumentation = self
+        def decorate(method):
+            if not instrumentation.enabled:
+                return method
+            def wrapper(*args, **kwargs):
+                record = getattr(instrumentation.local, 'record', None)
+                if record is None:
+                    return method(*args, **kwargs)
+                record.enter(phase)
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    record.leave()
+            wrapper.__name__ = method.__name__
+            wrapper.__doc__ = method.__doc__
+            return wrapper
+        return decorate
+
+    def cursor(self, cursor):
+        """Wraps cursor so the running command's SQL time is recorded."""
+        if not self.enabled:
+            return cursor
+        record = getattr(self.local, 'record', None)
+        if record is None:
+            return cursor
+        return InstrumentedCursor(cursor, record)
+
+    def size(self, result):
+        if isinstance(result, tuple):
+            return sum([self.size(part) for part in result])
+        if isinstance(result, (str, type(u''))):
+            return len(result)
+        return 0
+
+    def finish(self, record, args, failed):
+        elapsed = record.finish()
+        self.lock.acquire()
+        try:
+            totals = self.totals.get(record.name)
+            if totals is None:
+                totals = dict([(phase, 0.0) for phase in self.phases])
+                totals.update({'calls': 0, 'errors': 0, 'time': 0.0, 'max_time': 0.0,
+                               'queries': 0, 'rows': 0, 'bytes': 0})
+                self.totals[record.name] = totals
+            totals['calls'] += 1
+            totals['errors'] += failed and 1 or 0
+            totals['time'] += elapsed
+            totals['max_time'] = max(totals['max_time'], elapsed)
+            for phase in self.phases:
+                totals[phase] += record.times[phase]
+            totals['queries'] += record.queries
+            totals['rows'] += record.rows
+            totals['bytes'] += record.bytes
+            dump = self.dump_interval and time.time() - self.last_dump >= self.dump_interval
+            if dump:
+                self.last_dump = time.time()
+        finally:
+            self.lock.release()
+        if elapsed >= self.slow_time:
+            entry = {'command': record.name, 'args': repr(args)[:200], 'time': elapsed,
+                     'failed': failed, 'queries': record.queries, 'rows': record.rows,
+                     'bytes': record.bytes}
+            entry.update(record.times)
+            log.warning('slow command %s', json.dumps(entry, sort_keys=True))
+        if dump:
+            log.info('command stats %s', json.dumps(self.stats(), sort_keys=True))
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return dict([(name, dict(totals)) for name, totals in self.totals.items()])
+        finally:
+            self.lock.release()
+
+trace_file = getattr(settings, 'wp_trace_file', None)
+instrumentation = Instrumentation(getattr(settings, 'wp_instrument', False),
+                                  getattr(settings, 'wp_slow_command_time', 1.0),
+                                  getattr(settings, 'wp_instrument_dump_interval', 0),
+                                  trace_file and CommandTrace(trace_file) or None)
+
+class NoSuchGroup(Exception):
+    """Raised for a group that is not (or no longer) configured."""
 
 class Papercut_Storage:
     """
@@ -34,17 +1329,178 @@ class Papercut_Storage:
     available on the 'storage' sub-directory.
     """
 
+    # connections come from the pool, one per thread
+    conn = property(lambda self: self.get_connection())
+    cursor = property(lambda self: instrumentation.cursor(self.get_cursor()))
+
+    # schema_version -> method bringing the tables to it from the one before
+    migrations = ['create_tables', 'rebuild_overview', 'create_rendered_table', 'create_search_table']
+
     def __init__(self):
-        self.conn = MySQLdb.connect(host=settings.dbhost, db=settings.dbname, user=settings.dbuser, passwd=settings.dbpass, charset='utf8', use_unicode=True)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS wp_newsgroup_meta(
+        """Sets up nothing but the statement cache: the connection, the
+        schema check and the first sync all wait for the first command.
+        """
+        # statements with their table names filled in, see prepare()
+        self.statements = {}
+        if getattr(settings, 'wp_sync_in_background', False):
+            scheduler.start(self)
+
+    def get_connection(self):
+        """Returns the calling thread's connection, first bringing the
+        schema up to date if this process has not checked it yet.
+        """
+        if not schema.checked:
+            schema.check(self)
+        return pool.get()
+
+    def get_cursor(self):
+        """Returns the default cursor of the calling thread's connection."""
+        if not schema.checked:
+            schema.check(self)
+        return pool.cursor()
+
+    def migrate_schema(self):
+        """Runs the migrations newer than the stored schema_version.
+
+        A MySQL named lock keeps several processes from migrating at once.
+        """
+        self.cursor.execute("SELECT GET_LOCK('papercut_wordpress_schema', 300)")
+        try:
+            version = self.get_schema_version()
+            for number in range(version + 1, len(self.migrations) + 1):
+                getattr(self, self.migrations[number - 1])()
+                self.set_sync_state({'schema_version': number})
+        finally:
+            self.cursor.execute("SELECT RELEASE_LOCK('papercut_wordpress_schema')")
+
+    def get_schema_version(self):
+        try:
+            found = self.cursor.execute(self.prepare("SELECT value FROM wp_newsgroup_state WHERE name='schema_version'"))
+        except MySQLdb.Error as e:
+            if e.args[0] == 1146: # no such table, nothing set up yet
+                return 0
+            raise
+        if found == 0:
+            return 0
+        return self.cursor.fetchone()[0]
+
+    def create_tables(self):
+        """Schema version 1: creates the newsgroup tables, or brings ones
+        created by unversioned releases up to date.
+        """
+        self.cursor.execute(self.prepare("""CREATE TABLE IF NOT EXISTS wp_newsgroup_meta(
                                article_number BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
-                               message_id CHAR(255) UNIQUE NOT NULL,
+                               message_id CHAR(255) NOT NULL,
                                id BIGINT NOT NULL, tbl CHAR(50), newsgroup CHAR(255),
-                               CONSTRAINT UNIQUE INDEX id_table (id, tbl),
-                               INDEX newsgroup (newsgroup)
-                               )""")
-        self.update_newsgroup_meta()
+                               datestamp INT UNSIGNED,
+                               CONSTRAINT UNIQUE INDEX id_table (id, tbl, newsgroup(100)),
+                               INDEX message_id (message_id),
+                               INDEX newsgroup (newsgroup),
+                               INDEX newsgroup_datestamp (newsgroup, datestamp)
+                               )"""))
+        if self.cursor.execute(self.prepare("SHOW COLUMNS FROM wp_newsgroup_meta LIKE 'datestamp'")) == 0:
+            self.add_meta_datestamp()
+        self.cursor.execute(self.prepare("""CREATE TABLE IF NOT EXISTS wp_newsgroup_state(
+                               name CHAR(255) NOT NULL PRIMARY KEY,
+                               value BIGINT NOT NULL DEFAULT 0
+                               )"""))
+        if self.cursor.execute(self.prepare("SHOW INDEX FROM wp_newsgroup_meta WHERE Key_name='id_table' AND Column_name='newsgroup'")) == 0:
+            self.add_meta_newsgroup_keys()
+        self.cursor.execute(self.prepare("""CREATE TABLE IF NOT EXISTS wp_newsgroup_overview(
+                               article_number BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+                               newsgroup CHAR(255) NOT NULL,
+                               subject TEXT, author TEXT, date_header CHAR(64),
+                               message_id CHAR(255), refs TEXT,
+                               bytes INT UNSIGNED, line_count INT UNSIGNED,
+                               version BIGINT NOT NULL DEFAULT 0,
+                               INDEX newsgroup (newsgroup, article_number),
+                               INDEX subject (newsgroup(100), subject(64)),
+                               INDEX author (newsgroup(100), author(64))
+                               )"""))
+        if self.cursor.execute(self.prepare("SHOW INDEX FROM wp_newsgroup_overview WHERE Key_name='subject'")) == 0:
+            self.add_overview_header_keys()
+
+    def rebuild_overview(self):
+        """Schema version 2: empties wp_newsgroup_overview so the next sync
+        fills it in again with full, space separated References chains.
+        """
+        self.cursor.execute(self.prepare("DELETE FROM wp_newsgroup_overview"))
+        self.cursor.execute(self.prepare("DELETE FROM wp_newsgroup_state WHERE name LIKE 'overview_mark:%'"))
+
+    def create_rendered_table(self):
+        """Schema version 3: adds wp_newsgroup_rendered, filled by
+        prerender().
+        """
+        self.cursor.execute(self.prepare("""CREATE TABLE IF NOT EXISTS wp_newsgroup_rendered(
+                               article_number BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+                               version BIGINT NOT NULL DEFAULT 0,
+                               body MEDIUMTEXT,
+                               bytes INT UNSIGNED, line_count INT UNSIGNED
+                               )"""))
+
+    def create_search_table(self):
+        """Schema version 4: adds wp_newsgroup_search, the FULLTEXT index
+        behind get_XSEARCH(), and has the next sync render every article
+        again to fill it in.
+
+        MyISAM keeps FULLTEXT working on MySQL servers older than 5.6.
+        """
+        self.cursor.execute(self.prepare("""CREATE TABLE IF NOT EXISTS wp_newsgroup_search(
+                               article_number BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+                               newsgroup CHAR(255) NOT NULL,
+                               subject TEXT, body MEDIUMTEXT,
+                               INDEX newsgroup (newsgroup(100), article_number),
+                               FULLTEXT INDEX text (subject, body)
+                               ) ENGINE=MyISAM"""))
+        self.cursor.execute(self.prepare("DELETE FROM wp_newsgroup_state WHERE name LIKE 'overview_mark:%'"))
+
+    def add_meta_datestamp(self):
+        """Adds the datestamp column to a wp_newsgroup_meta created before
+        it existed and fills it in for the articles already numbered.
+        """
+        self.cursor.execute(self.prepare("""
+                ALTER TABLE wp_newsgroup_meta
+                    ADD datestamp INT UNSIGNED,
+                    ADD INDEX newsgroup_datestamp (newsgroup, datestamp)
+               """))
+        self.cursor.execute(self.prepare("""
+                UPDATE wp_newsgroup_meta M, wp_posts A
+                SET M.datestamp=UNIX_TIMESTAMP(A.post_date_gmt)
+                WHERE M.id=A.ID AND M.tbl='wp_posts'
+               """))
+        self.cursor.execute(self.prepare("""
+                UPDATE wp_newsgroup_meta M, wp_comments A
+                SET M.datestamp=UNIX_TIMESTAMP(A.comment_date_gmt)
+                WHERE M.id=A.comment_ID AND M.tbl='wp_comments'
+               """))
+
+    def add_meta_newsgroup_keys(self):
+        """Lets an article be numbered once per group rather than once
+        overall, so it can appear in both its blog's and its category's
+        group.
+        """
+        self.cursor.execute(self.prepare("""
+                ALTER TABLE wp_newsgroup_meta
+                    DROP INDEX id_table,
+                    ADD UNIQUE INDEX id_table (id, tbl, newsgroup(100)),
+                    DROP INDEX message_id,
+                    ADD INDEX message_id (message_id)
+               """))
+        self.cursor.execute(self.prepare("ALTER TABLE wp_newsgroup_state MODIFY name CHAR(255) NOT NULL"))
+
+    def add_overview_header_keys(self):
+        """Indexes the Subject and From prefixes of wp_newsgroup_overview
+        so XPAT patterns with a literal prefix avoid a group scan.
+        """
+        self.cursor.execute(self.prepare("""
+                ALTER TABLE wp_newsgroup_overview
+                    ADD INDEX subject (newsgroup(100), subject(64)),
+                    ADD INDEX author (newsgroup(100), author(64))
+               """))
+
+    def release(self):
+        """Hands the calling thread's connection back to the pool."""
+        pool.release()
 
     def get_message_body(self, headers):
         """Parses and returns the most appropriate message body possible.
@@ -58,554 +1514,1464 @@ class Papercut_Storage:
         """Quotes strings the MySQL way."""
         return text.replace("'", "\\'")
 
+    @pool.command
     def group_exists(self, group_name):
-        return (group_name == 'blog.singpolyma') # TODO
-
-    def update_newsgroup_meta(self):
-        group = 'blog.singpolyma' # TODO
-        meta_table = self.get_table_name(table_name='newsgroup_meta')
-        posts_table = self.get_table_name(table_name='posts')
-        comments_table = self.get_table_name(table_name='comments')
-        stmt = """ INSERT INTO wp_newsgroup_meta (id, tbl, message_id, newsgroup)
-                   SELECT ID, tbl, message_id, '%s' FROM (
+        return group_name in self.get_groups()
+
+    def get_groups(self):
+        """Returns the group registry, a dict of group name -> group."""
+        return groups.get(self)
+
+    def get_group(self, group_name):
+        return self.get_groups().get(group_name)
+
+    def require_group(self, group_name):
+        """Returns the group, raising NoSuchGroup if it is not configured."""
+        group = self.get_group(group_name)
+        if group is None:
+            raise NoSuchGroup(group_name)
+        return group
+
+    def get_category_filter(self, group_name, column):
+        """Returns the condition limiting a category group to its posts, to
+        be put into a statement before it goes through prepare().
+        """
+        group = self.require_group(group_name)
+        if group['term_taxonomy_id'] is None:
+            return '1=1'
+        return "%s IN (SELECT object_id FROM wp_term_relationships WHERE term_taxonomy_id=%d)" % (column, int(group['term_taxonomy_id']))
+
+    def get_sync_state(self):
+        """Returns the sync watermarks stored in the state table as a dict."""
+        self.cursor.execute(self.prepare("SELECT name, value FROM wp_newsgroup_state"))
+        return dict(self.cursor.fetchall())
+
+    def set_sync_state(self, values):
+        if len(values) == 0:
+            return
+        stmt = self.prepare("""
+                INSERT INTO wp_newsgroup_state (name, value) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE value=VALUES(value)
+               """)
+        self.cursor.executemany(stmt, [(name, int(value)) for name, value in values.items()])
+
+    @instrumentation.phase('sync')
+    def request_sync(self):
+        """Brings the meta tables up to date before a command reads them,
+        or just nudges the background sync when that is enabled.
+        """
+        if scheduler.thread is not None:
+            scheduler.request()
+        else:
+            scheduler.run_inline(self)
+
+    def update_newsgroup_meta(self, full=False, overview=True):
+        """Numbers the new posts and comments of every group, in datestamp
+        order, and (unless overview is False) brings the overview up to date.
+        """
+        now = int(time.time())
+        state = self.get_sync_state()
+        if now - state.get('full_sync', 0) >= getattr(settings, 'wp_full_sync_interval', 3600):
+            full = True
+        added = 0
+        for group_name in sorted(self.get_groups().keys()):
+            added += self.update_group_meta(group_name, state, now, full, overview)
+        if full and overview:
+            self.set_sync_state({'full_sync': now})
+        self.conn.commit()
+        self.update_article_indexes()
+        return added
+
+    def update_group_meta(self, group_name, state, now, full=False, overview=True):
+        group = self.require_group(group_name)
+        if full:
+            post_mark = comment_mark = modified_mark = 0
+        else:
+            post_mark = state.get('post_mark:' + group_name, 0)
+            comment_mark = state.get('comment_mark:' + group_name, 0)
+            modified_mark = state.get('post_modified_mark:' + group_name, 0)
+        stmt = """ INSERT INTO wp_newsgroup_meta (id, tbl, message_id, newsgroup, datestamp)
+                   SELECT ID, tbl, message_id, %%s, datestamp FROM (
                    (SELECT
                        a.ID, 'wp_posts' AS tbl,
-                       CONCAT('<post-', a.ID, '@%s>') AS message_id,
-                       post_date_gmt AS datestamp
+                       CONCAT('<post-', a.ID, '@', %%s, '>') AS message_id,
+                       UNIX_TIMESTAMP(post_date_gmt) AS datestamp
                    FROM
-                       wp_posts a LEFT JOIN wp_newsgroup_meta b ON a.ID=b.id AND b.tbl='wp_posts'
+                       wp_posts a LEFT JOIN wp_newsgroup_meta b ON a.ID=b.id AND b.tbl='wp_posts' AND b.newsgroup=%%s
                    WHERE
-                       isNULL(b.id) AND post_type='post' AND post_status='publish'
+                       isNULL(b.id) AND post_type='post' AND post_status='publish' AND
+                       (a.ID > %%s OR a.post_modified_gmt >= %%s) AND
+                       %s
                    ) UNION (
                    SELECT
                        comment_ID as ID, 'wp_comments' AS tbl,
-                       CONCAT('<comment-', comment_ID, '@%s>') AS message_id,
-                       comment_date_gmt AS datestamp
+                       CONCAT('<comment-', comment_ID, '@', %%s, '>') AS message_id,
+                       UNIX_TIMESTAMP(comment_date_gmt) AS datestamp
                    FROM
-                       wp_posts c, wp_comments a LEFT JOIN wp_newsgroup_meta b ON comment_ID=b.id AND b.tbl='wp_comments'
+                       wp_posts c, wp_comments a LEFT JOIN wp_newsgroup_meta b ON comment_ID=b.id AND b.tbl='wp_comments' AND b.newsgroup=%%s
                    WHERE
-                       a.comment_post_ID=c.ID AND
+                       a.comment_ID > %%s AND a.comment_post_ID=c.ID AND
                        isNULL(b.id) AND comment_approved='1' AND
-                       post_type='post' AND post_status='publish'
-                   )
-                   ORDER BY datestamp) t
-               """.replace('wp_posts', posts_table).replace('wp_comments', comments_table).replace('wp_newsgroup_meta', meta_table) % (group, settings.nntp_hostname, settings.nntp_hostname)
-        self.cursor.execute(stmt)
+                       post_type='post' AND post_status='publish' AND
+                       %s
+                   )) t
+                   ORDER BY datestamp
+               """ % (self.get_category_filter(group_name, 'a.ID'), self.get_category_filter(group_name, 'c.ID'))
+        added = self.cursor.execute(self.prepare(stmt, group_name),
+                                    (group_name, group['host'], group_name, post_mark, gmt_datetime(modified_mark),
+                                     group['host'], group_name, comment_mark))
+        stmt = self.prepare("""
+                SELECT
+                    (SELECT MAX(id) FROM wp_newsgroup_meta WHERE tbl='wp_posts' AND id > %s AND newsgroup=%s),
+                    (SELECT MAX(id) FROM wp_newsgroup_meta WHERE tbl='wp_comments' AND id > %s AND newsgroup=%s)
+               """, group_name)
+        self.cursor.execute(stmt, (post_mark, group_name, comment_mark, group_name))
+        max_post, max_comment = self.cursor.fetchone()
+        values = {}
+        if max_post is not None:
+            values['post_mark:' + group_name] = max_post
+        if max_comment is not None:
+            values['comment_mark:' + group_name] = max_comment
+        if overview:
+            # without the overview pass, modified posts wait for the next one
+            values['post_modified_mark:' + group_name] = now
+            self.update_newsgroup_overview(group_name, modified_mark, full)
+        if full:
+            self.remove_group_meta(group_name)
+        self.set_sync_state(values)
+        return added
 
-    def article_exists(self, group_name, style, range):
-        self.update_newsgroup_meta()
-        table_name = self.get_table_name(table_name='newsgroup_meta')
-        stmt = """
+    def remove_group_meta(self, group_name):
+        """Drops the numbers of articles that are no longer visible (deleted,
+        unpublished, unapproved or moved out of the category); an article
+        that comes back later gets a new number.
+        """
+        stmt, args = self.get_article_sql(group_name, prefix="""
+                DELETE FROM wp_newsgroup_meta
+                WHERE newsgroup=%s AND
+                      article_number NOT IN (SELECT article_number FROM (""", suffix=") X)")
+        if self.cursor.execute(stmt, (group_name,) + args) > 0:
+            self.cursor.execute(self.prepare("""
+                    INSERT INTO wp_newsgroup_state (name, value) VALUES ('meta_generation', 1)
+                    ON DUPLICATE KEY UPDATE value=value+1
+                   """))
+
+    def update_article_indexes(self):
+        """Brings the loaded article indexes and the group stats cache up to
+        the newest meta rows.
+        """
+        self.cursor.execute(self.prepare("""
                 SELECT
-                    COUNT(*) AS total
+                    MAX(article_number),
+                    (SELECT value FROM wp_newsgroup_state WHERE name='meta_generation')
                 FROM
-                    %s
+                    wp_newsgroup_meta"""))
+        seen, generation = self.cursor.fetchone()
+        watermark = (seen or 0, generation or 0)
+        if group_stats.watermark is not None and group_stats.watermark[1] != watermark[1]:
+            # articles were removed; indexes only ever append, so rebuild
+            article_indexes_lock.acquire()
+            article_indexes.clear()
+            article_indexes_lock.release()
+        group_stats.check(watermark)
+        for index in list(article_indexes.values()):
+            if index.seen < watermark[0]:
+                index.update(self, watermark[0])
+
+    def get_article_index(self, group_name):
+        """Returns the ArticleIndex of a group, loading it on first use."""
+        index = article_indexes.get(group_name)
+        if index is None:
+            article_indexes_lock.acquire()
+            try:
+                index = article_indexes.get(group_name)
+                if index is None:
+                    index = ArticleIndex(group_name, self.require_group(group_name)['host'])
+                    index.update(self)
+                    article_indexes[group_name] = index
+            finally:
+                article_indexes_lock.release()
+        return index
+
+    def update_newsgroup_overview(self, group_name, modified_mark, full=False):
+        """Keeps wp_newsgroup_overview in step with wp_newsgroup_meta.
+
+        Articles numbered since the last run are rendered and stored, and
+        posts modified since modified_mark are rendered again.  Comments
+        carry no modification time, so edited comments (and articles that
+        stopped being visible) are only caught by a full sync, which
+        compares every stored version and repairs References chains that
+        no longer match their parent's (see repair_references()).
+        """
+        mark = self.get_sync_state().get('overview_mark:' + group_name, 0)
+        while True:
+            stmt, args = self.get_article_sql(group_name, "M.article_number > %s", (mark,),
+                                              suffix=" ORDER BY S.article_number LIMIT 500")
+            self.cursor.execute(stmt, args)
+            rows = self.cursor.fetchall()
+            if len(rows) == 0:
+                break
+            self.store_overview(rows)
+            mark = rows[-1][0]
+        self.set_sync_state({'overview_mark:' + group_name: mark})
+        if full:
+            stmt, args = self.get_article_sql(group_name, suffix=" AND S.version <> (SELECT O.version FROM wp_newsgroup_overview O WHERE O.article_number=S.article_number)")
+        else:
+            stmt, args = self.get_article_sql(group_name, "M.tbl='wp_posts' AND T.post_modified_gmt >= %s", (gmt_datetime(modified_mark),))
+        self.cursor.execute(stmt, args)
+        rows = self.cursor.fetchall()
+        self.store_overview(rows)
+        # other processes may have spooled the old text
+        spool.expect([(row[0], row[12]) for row in rows])
+        if full:
+            stmt, args = self.get_article_sql(group_name, prefix="""
+                    DELETE FROM wp_newsgroup_overview
+                    WHERE newsgroup=%s AND
+                          article_number NOT IN (SELECT article_number FROM (""", suffix=") X)")
+            self.cursor.execute(stmt, (group_name,) + args)
+            stmt = self.prepare("""
+                    DELETE S FROM
+                        wp_newsgroup_search S LEFT JOIN wp_newsgroup_overview O ON O.article_number=S.article_number
+                    WHERE
+                        S.newsgroup=%s AND O.article_number IS NULL""")
+            self.cursor.execute(stmt, (group_name,))
+            self.repair_references(group_name)
+
+    def repair_references(self, group_name):
+        """Gives every reply the References chain of its parent followed by
+        the parent itself.
+
+        A chain goes stale when the parent's own chain changes after the
+        reply was stored (a parent approved later, an overview reset).
+        Each pass fixes one more level of the thread, so it runs until a
+        pass finds nothing left to fix.
+        """
+        stmt = self.prepare("""
+                UPDATE
+                    wp_newsgroup_overview C, wp_newsgroup_meta MC, wp_comments A,
+                    wp_newsgroup_meta MP, wp_newsgroup_overview P
+                SET
+                    C.refs=TRIM(CONCAT(COALESCE(P.refs, ''), ' ', P.message_id))
                 WHERE
-                    newsgroup='%s' AND """ % (table_name, group_name)
+                    C.newsgroup=%s AND
+                    MC.article_number=C.article_number AND MC.tbl='wp_comments' AND
+                    A.comment_ID=MC.id AND A.comment_parent<>0 AND
+                    MP.id=A.comment_parent AND MP.tbl='wp_comments' AND MP.newsgroup=C.newsgroup AND
+                    P.article_number=MP.article_number AND
+                    C.refs<>TRIM(CONCAT(COALESCE(P.refs, ''), ' ', P.message_id))""", group_name)
+        # threads are rarely this deep; the bound only guards against loops
+        for depth in range(100):
+            if self.cursor.execute(stmt, (group_name,)) == 0:
+                break
+
+    def store_overview(self, rows):
+        """Renders get_article_sql() rows and saves their overview fields
+        and search text.
+        """
+        values = []
+        texts = []
+        # References of the rows stored so far, for replies in the same batch
+        known = {}
+        for row in rows:
+            try:
+                body = self.get_body(row)
+                formatted_time = strutil.get_formatted_time(time.localtime(row[5]))
+                refs = ' '.join(self.get_references(row, known))
+                author = self.get_author(row)
+            except MySQLdb.Error:
+                raise
+            except Exception:
+                # one broken row must not stall the sync of the others
+                log.exception('cannot render article %s of %s', row[0], row[13])
+                body, formatted_time, refs, author = '', '', '', ''
+            known[row[9]] = refs
+            values.append((row[0], row[13], row[4] or '', author, formatted_time, row[9], refs, len(body), body.count("\n"), row[12]))
+            texts.append((row[0], row[13], row[4] or '', body))
+        if len(values) == 0:
+            return
+        stmt = self.prepare("""
+                REPLACE INTO wp_newsgroup_overview
+                    (article_number, newsgroup, subject, author, date_header,
+                     message_id, refs, bytes, line_count, version)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+               """)
+        self.cursor.executemany(stmt, values)
+        stmt = self.prepare("""
+                REPLACE INTO wp_newsgroup_search
+                    (article_number, newsgroup, subject, body)
+                VALUES (%s, %s, %s, %s)
+               """)
+        self.cursor.executemany(stmt, texts)
+
+    def prerender(self, group_name=None, processes=None, chunk_size=500, full=False):
+        """Renders the bodies of the numbered articles (of group_name, or
+        of every group) into wp_newsgroup_rendered on a pool of processes,
+        so that neither the overview sync nor ARTICLE has to.
+
+        Articles are read in article number order, chunk_size at a time,
+        the next chunk being fetched while the last one renders; those
+        already rendered at their current version are skipped.  Progress is
+        kept as render_mark:<group> in the state table so an interrupted
+        run carries on where it stopped; full starts from the beginning
+        again.  Returns the totals and throughput.
+        """
+        import multiprocessing
+        workers = multiprocessing.Pool(processes)
+        totals = {'articles': 0, 'bytes': 0}
+        started = time.time()
+        try:
+            if group_name is None:
+                names = sorted(self.get_groups().keys())
+            else:
+                names = [group_name]
+            for name in names:
+                self.prerender_group(name, workers, chunk_size, full, totals, started)
+            workers.close()
+        except:
+            workers.terminate()
+            raise
+        workers.join()
+        elapsed = time.time() - started
+        totals['seconds'] = elapsed
+        totals['articles_per_second'] = elapsed and totals['articles'] / elapsed or 0.0
+        totals['bytes_per_second'] = elapsed and totals['bytes'] / elapsed or 0.0
+        return totals
+
+    def prerender_group(self, group_name, workers, chunk_size, full, totals, started):
+        mark = 0
+        if not full:
+            mark = self.get_sync_state().get('render_mark:' + group_name, 0)
+        pending = None
+        while True:
+            stmt, args = self.get_article_sql(group_name, "M.article_number > %s", (mark,),
+                                              suffix=" AND Q.article_number IS NULL ORDER BY S.article_number LIMIT %d" % (int(chunk_size),))
+            self.cursor.execute(stmt, args)
+            rows = self.cursor.fetchall()
+            if pending is not None:
+                # a day's timeout keeps the wait interruptible
+                totals['bytes'] += self.store_rendered(group_name, pending[0], pending[1].get(86400))
+                totals['articles'] += len(pending[0])
+                elapsed = time.time() - started
+                log.info('prerender %s: %s articles, %.1f articles/s', group_name, totals['articles'],
+                         elapsed and totals['articles'] / elapsed or 0.0)
+            if len(rows) == 0:
+                break
+            pending = (rows, workers.map_async(render_html, [row[6] for row in rows]))
+            mark = rows[-1][0]
+
+    def store_rendered(self, group_name, rows, bodies):
+        """Saves rendered bodies and moves the group's render mark past
+        them; returns the bytes stored.
+        """
+        values = []
+        for row, body in zip(rows, bodies):
+            values.append((row[0], row[12], body, len(body), body.count("\n")))
+        stmt = self.prepare("""
+                REPLACE INTO wp_newsgroup_rendered
+                    (article_number, version, body, bytes, line_count)
+                VALUES (%s, %s, %s, %s, %s)
+               """)
+        self.cursor.executemany(stmt, values)
+        self.set_sync_state({'render_mark:' + group_name: rows[-1][0]})
+        return sum([value[3] for value in values])
+
+    @pool.command
+    def article_exists(self, group_name, style, range):
+        self.request_sync()
+        index = self.get_article_index(group_name)
         if style == 'range':
-            stmt = "%s AND article_number > %s" % (stmt, range[0])
+            # the bounds of a range are exclusive here, as they always were
             if len(range) == 2:
-                stmt = "%s AND article_number < %s" % (stmt, range[1])
+                return index.count(int(range[0]) + 1, int(range[1]) - 1)
+            return index.count(int(range[0]) + 1)
         else:
-            stmt = "%s AND article_number = %s" % (stmt, range[0])
-        self.cursor.execute(stmt)
-        return self.cursor.fetchone()[0]
+            return index.count(int(range[0]), int(range[0]))
 
+    @pool.command
     def get_first_article(self, group_name):
-        self.update_newsgroup_meta()
-        table_name = self.get_table_name(table_name='newsgroup_meta')
-        stmt = """
-                SELECT
-                    IF(MIN(message_num) IS NULL, 0, MIN(message_num)) AS first_article
-                FROM
-                    %s
-                WHERE
-                   newsgroup='%s'""" % (table_name, group_name)
-        num_rows = self.cursor.execute(stmt)
-        return self.cursor.fetchone()[0]
+        self.request_sync()
+        return self.get_article_index(group_name).first()
 
+    @pool.command
     def get_group_stats(self, group_name):
-        self.update_newsgroup_meta()
-        table_name = self.get_table_name(table_name='newsgroup_meta')
-        stmt = """
+        self.request_sync()
+        total, mini, maxi = group_stats.get(self).get(group_name, (0, 0, 0))
+        return (total, mini, maxi, group_name)
+
+    def get_all_group_stats(self):
+        """Returns {group name: (total, low, high)} for every group with
+        articles.
+        """
+        self.request_sync()
+        return group_stats.get(self)
+
+    def load_group_stats(self):
+        self.cursor.execute(self.prepare("""
                 SELECT
+                   newsgroup,
                    COUNT(article_number) AS total,
-                   IF(MAX(article_number) IS NULL, 0, MAX(article_number)) AS maximum,
-                   IF(MIN(article_number) IS NULL, 0, MIN(article_number)) AS minimum
+                   MIN(article_number) AS minimum,
+                   MAX(article_number) AS maximum
                 FROM
-                    %s
-                WHERE
-                    newsgroup='%s'""" % (table_name, group_name)
-        self.cursor.execute(stmt)
-        total, maxi, mini = self.cursor.fetchone()
-        return (total, mini, maxi, group_name)
+                    wp_newsgroup_meta
+                GROUP BY
+                    newsgroup"""))
+        stats = {}
+        for group_name, total, mini, maxi in self.cursor.fetchall():
+            stats[group_name] = (total, mini, maxi)
+        return stats
 
     def get_table_name(self, group_name=None, table_name=None):
         if not table_name:
             table_name = 'posts'
-        return 'wp_' + table_name # TODO
+        if group_name is None or table_name in shared_tables:
+            return table_prefix + table_name
+        return self.require_group(group_name)['prefix'] + table_name
+
+    def prepare(self, stmt, group_name=None):
+        """Returns stmt with every wp_ table name replaced by the real one
+        for group_name (shared tables by the shared one).
 
+        Values are never part of a statement; they are bound by MySQLdb
+        from %s placeholders.  The substituted text is kept per storage
+        instance, so each statement is rewritten once and MySQL always sees
+        the same text for it.
+        """
+        key = (group_name, stmt)
+        prepared = self.statements.get(key)
+        if prepared is None:
+            prepared = self.substitute_tables(stmt, group_name)
+            self.statements[key] = prepared
+        return prepared
+
+    def substitute_tables(self, stmt, group_name=None):
+        return table_regexp.sub(lambda match: self.get_table_name(group_name, match.group(1)), stmt)
+
+    @pool.command
     def get_message_id(self, msg_num, group, table=None):
-        table_name = self.get_table_name(table_name='newsgroup_meta')
-        compar = table and 'id' or 'article_number'
-        stmt = """
-               SELECT
-                   message_id
-               FROM
-                   %s
-               WHERE
-                   newsgroup='%s' AND %s=%s
-               """ % (table_name, group, compar, int(msg_num))
+        index = self.get_article_index(group)
         if table:
-            stmt += " AND tbl='%s'" % self.get_table_name(table_name=table)
-        self.cursor.execute(stmt)
-        return self.cursor.fetchone()[0]
+            msg_num = index.find(int(msg_num), table == 'comments' and 1 or 0)
+            if msg_num is None:
+                return None
+        return index.get_message_id(msg_num)
 
-    def get_article_sql(self):
-        meta_table = self.get_table_name(table_name='newsgroup_meta')
-        posts_table = self.get_table_name(table_name='posts')
-        comments_table = self.get_table_name(table_name='comments')
-        stmt = """
-                SELECT M.article_number,S.*,M.message_id FROM (
-                (SELECT
-                    A.ID as ID,
-                    display_name,
-                    user_email,
+    def get_article_sql(self, group_name, where='1=1', args=(), tbl=None, prefix='', suffix=''):
+        """Returns the statement selecting the numbered articles matching
+        where (on M, the meta row, and T, the post) and its arguments.
+        """
+        key = ('article', group_name, where, tbl, prefix, suffix)
+        prepared = self.statements.get(key)
+        if prepared is None:
+            prepared = self.build_article_sql(group_name, where, tbl, prefix, suffix)
+            self.statements[key] = prepared
+        stmt, branches = prepared
+        return stmt, ((group_name,) + tuple(args)) * branches
+
+    def build_article_sql(self, group_name, where, tbl, prefix, suffix):
+        where = "M.newsgroup=%s AND " + self.get_category_filter(group_name, 'T.ID') + " AND (" + where + ")"
+        posts_stmt = """
+                SELECT
+                    M.article_number,
+                    T.ID as ID,
+                    COALESCE(display_name, '') AS display_name,
+                    COALESCE(user_email, '') AS user_email,
                     post_title,
                     UNIX_TIMESTAMP(post_date_gmt) AS datestamp,
                     post_content,
                     post_parent,
-                    0 AS comment_parent
+                    0 AS comment_parent,
+                    M.message_id,
+                    UNIX_TIMESTAMP(post_modified_gmt) AS version,
+                    M.newsgroup
                 FROM
-                    wp_posts A,
-                    wp_users
+                    wp_posts T,
+                    wp_users,
+                    wp_newsgroup_meta M
                 WHERE
-                    A.post_type='post' AND A.post_status='publish' AND
-                    A.post_author=wp_users.ID
-               ) UNION (
+                    T.post_type='post' AND T.post_status='publish' AND
+                    T.post_author=wp_users.ID AND
+                    M.id=T.ID AND M.tbl='wp_posts' AND
+                    """ + where
+        comments_stmt = """
                SELECT
+                   M.article_number,
                    comment_ID AS ID,
-                   IF(user_id = 0, comment_author, display_name) as display_name,
-                   IF(user_id = 0, comment_author_email, user_email) as user_email,
+                   COALESCE(IF(user_id = 0, comment_author, display_name), comment_author, '') as display_name,
+                   COALESCE(IF(user_id = 0, comment_author_email, user_email), comment_author_email, '') as user_email,
                    CONCAT('Re: ', post_title) as post_title,
                    UNIX_TIMESTAMP(comment_date_gmt) AS datestamp,
                    comment_content AS post_content,
                    comment_post_ID AS post_parent,
-                   comment_parent
+                   comment_parent,
+                   M.message_id,
+                   CRC32(comment_content) AS version,
+                   M.newsgroup
                FROM
                    wp_comments A LEFT OUTER JOIN
                    wp_users ON user_id=wp_users.ID,
-                   wp_posts
+                   wp_posts T,
+                   wp_newsgroup_meta M
                WHERE
-                   comment_post_ID=wp_posts.ID AND
+                   comment_post_ID=T.ID AND
                    comment_approved='1' AND
-                   wp_posts.post_type='post' AND wp_posts.post_status='publish'
-               ) ) S, wp_newsgroup_meta M
+                   T.post_type='post' AND T.post_status='publish' AND
+                   M.id=A.comment_ID AND M.tbl='wp_comments' AND
+                   """ + where
+        branches = []
+        if tbl is None or tbl == self.get_table_name(group_name, 'posts'):
+            branches.append(posts_stmt)
+        if tbl is None or tbl == self.get_table_name(group_name, 'comments'):
+            branches.append(comments_stmt)
+        stmt = """
+                SELECT
+                    S.article_number, S.ID, S.display_name, S.user_email,
+                    S.post_title, S.datestamp, S.post_content, S.post_parent,
+                    S.comment_parent, S.message_id,
+                    P.message_id AS post_parent_message_id,
+                    C.message_id AS comment_parent_message_id,
+                    S.version, S.newsgroup,
+                    R.refs AS comment_parent_refs,
+                    Q.body AS rendered_body
+                FROM (""" + ' UNION ALL '.join(branches) + """) S
+               LEFT JOIN wp_newsgroup_meta P ON P.id=S.post_parent AND P.tbl='wp_posts' AND P.newsgroup=S.newsgroup
+               LEFT JOIN wp_newsgroup_meta C ON C.id=S.comment_parent AND C.tbl='wp_comments' AND C.newsgroup=S.newsgroup
+               LEFT JOIN wp_newsgroup_overview R ON R.article_number=C.article_number
+               LEFT JOIN wp_newsgroup_rendered Q ON Q.article_number=S.article_number AND Q.version=S.version
                WHERE
-                   M.id=S.ID
-               """.replace('wp_posts', posts_table).replace('wp_comments', comments_table).replace('wp_newsgroup_meta',     meta_table)
-        return stmt
+                   1=1"""
+        return self.substitute_tables(prefix + stmt + suffix, group_name), len(branches)
+
+    def get_article_meta(self, group_name, id):
+        """Resolves an article number or Message-ID to its meta row,
+        (article_number, id, tbl, newsgroup), or None.
+
+        The group's ArticleIndex answers this without a query; only
+        Message-IDs of other groups fall through to wp_newsgroup_meta, and
+        only to groups that are still configured.
+        """
+        is_number = not self.is_message_id(id)
+        if self.group_exists(group_name):
+            index = self.get_article_index(group_name)
+            if is_number:
+                return index.lookup(int(id))
+            number = index.get_number(id)
+            if number is not None:
+                return index.lookup(number)
+        elif is_number:
+            return None
+        stmt = self.prepare("""
+                SELECT
+                    article_number, id, tbl, newsgroup
+                FROM
+                    wp_newsgroup_meta
+                WHERE
+                    message_id=%s""")
+        self.cursor.execute(stmt, (id,))
+        for meta in self.cursor.fetchall():
+            if self.group_exists(meta[3]):
+                return meta
+        return None
+
+    @instrumentation.phase('render')
+    def render_body(self, content):
+        """Renders the HTML of a post or comment as the article body."""
+        return render_html(content)
+
+    def get_body(self, row):
+        """Returns the body of a get_article_sql() row, from
+        wp_newsgroup_rendered when it was rendered at the row's version.
+        """
+        if row[15] is not None:
+            return row[15].encode('utf-8')
+        return self.render_body(row[6])
+
+    def get_author(self, row):
+        """Returns the From value of a get_article_sql() row."""
+        if not row[3]:
+            return row[2] or ''
+        else:
+            return "%s <%s>" % (row[2], row[3])
+
+    def get_references(self, row, known=None):
+        """Returns the References chain of a get_article_sql() row, oldest
+        first.
+
+        A reply to a comment gets the chain stored in the overview for that
+        comment (or in known, Message-ID -> References, when it was stored
+        along with this row) followed by the comment itself, so the whole
+        ancestry usually comes from one indexed read; only when the parent
+        is not in the overview yet is comment_parent walked up instead.
+        """
+        if row[8] != 0 and row[11]:
+            chain = (known and known.get(row[11])) or row[14]
+            if chain:
+                refs = chain.split()
+            else:
+                refs = row[10] and [row[10]] or []
+                refs.extend(self.walk_references(row[13], row[8]))
+            refs.append(row[11])
+            return refs
+        if row[7] != 0 and row[10]:
+            return [row[10]]
+        return []
+
+    def walk_references(self, group_name, comment_id):
+        """Returns the Message-IDs of the numbered comments above comment_id
+        in its thread, oldest first, by following comment_parent.
+        """
+        stmt = self.prepare("""
+                SELECT
+                    A.comment_parent, M.message_id
+                FROM
+                    wp_comments A LEFT JOIN wp_newsgroup_meta M ON
+                    M.id=A.comment_parent AND M.tbl='wp_comments' AND M.newsgroup=%s
+                WHERE
+                    A.comment_ID=%s""", group_name)
+        ancestors = []
+        seen = set()
+        parent = comment_id
+        while parent and parent not in seen and len(seen) < 100:
+            seen.add(parent)
+            if self.cursor.execute(stmt, (group_name, parent)) == 0:
+                break
+            parent, message_id = self.cursor.fetchone()
+            if parent and message_id:
+                ancestors.append(message_id)
+        ancestors.reverse()
+        return ancestors
+
+    def stream_query(self, stmt, args=()):
+        """Runs stmt with args on an unbuffered server side cursor, yielding
+        lists of at most wp_stream_chunk_size rows.
+
+        The connection is busy until the generator is exhausted or closed,
+        so callers must not run other queries while iterating.  Papercut
+        wants a whole response string from get_*, so the rows are only
+        streamed end to end for callers of the iter_* methods.
+        """
+        chunk_size = getattr(settings, 'wp_stream_chunk_size', 1000)
+        pool.open_stream()
+        try:
+            cursor = instrumentation.cursor(self.conn.cursor(MySQLdb.cursors.SSCursor))
+            try:
+                cursor.execute(stmt, args)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+        finally:
+            pool.close_stream()
 
+    @instrumentation.command
     def get_NEWGROUPS(self, ts, group='%'):
         return None # TODO
 
+    @instrumentation.command
     def get_NEWNEWS(self, ts, group='*'):
-        self.update_newsgroup_meta()
-        group = 'blog.singpolyma' # TODO
-        meta_table = self.get_table_name(table_name='newsgroup_meta')
-        posts_table = self.get_table_name(table_name='posts')
-        comments_table = self.get_table_name(table_name='comments')
+        return "\r\n".join(self.iter_NEWNEWS(ts, group))
+
+    def iter_NEWNEWS(self, ts, group='*'):
+        """Yields the Message-IDs of articles dated ts or later in the
+        groups matching the wildmat group, using the (newsgroup, datestamp)
+        index of wp_newsgroup_meta.
+        """
+        self.request_sync()
         ts = int(time.mktime(ts))
-        stmt = """
-                (SELECT
-                    article_number
-                FROM
-                    wp_posts, wp_newsgroup_meta
-                WHERE
-                    wp_posts.ID=wp_newsgroup_meta.id AND wp_newsgroup_meta.tbl='wp_posts' AND
-                    post_type='post' AND post_status='publish' AND
-                    UNIX_TIMESTAMP(post_date_gmt) >= %s
-                ) UNION (
+        stmt = self.prepare("""
                 SELECT
-                   article_number
+                    M.message_id
                 FROM
-                    wp_comments,
-                    wp_posts,
-                    wp_newsgroup_meta
+                    wp_newsgroup_meta M, wp_newsgroup_overview O
                 WHERE
-                    comment_ID=wp_newsgroup_meta.id AND wp_newsgroup_meta.tbl='wp_comments' AND
-                    comment_post_ID=wp_posts.ID AND
-                    post_type='post' AND post_status='publish' AND
-                    comment_approved = '1' AND
-                    UNIX_TIMESTAMP(comment_date_gmt) >= %s
-                )
+                    M.newsgroup=%s AND M.datestamp >= %s AND
+                    O.article_number=M.article_number
                 ORDER BY
-                    article_number ASC""" % (ts, ts)
-        stmt = stmt.replace('wp_posts', posts_table).replace('wp_comments', comments_table).replace('wp_newsgroup_meta',  meta_table)
-        self.cursor.execute(stmt)
-        result = list(self.cursor.fetchall())
-        return "\r\n".join(["%s" % k for k in result])
+                    M.datestamp ASC""")
+        for group_name in sorted(self.get_groups().keys()):
+            if not wildmat(group, group_name):
+                continue
+            for rows in self.stream_query(stmt, (group_name, ts)):
+                yield "\r\n".join(["%s" % k for k in rows])
 
+    @instrumentation.command
     def get_GROUP(self, group_name):
         stats = self.get_group_stats(group_name)
         return (stats[0], stats[1], stats[2])
 
+    @instrumentation.command
     def get_LIST(self, username=""):
+        stats = self.get_all_group_stats()
         lists = []
-        stats = self.get_group_stats('blog.singpolyma')
-        lists.append("%s %s %s y" % ('blog.singpolyma', stats[2], stats[1])) # TODO
+        for group_name in sorted(self.get_groups().keys()):
+            total, mini, maxi = stats.get(group_name, (0, 0, 0))
+            lists.append("%s %s %s y" % (group_name, maxi, mini))
         return "\r\n".join(lists)
 
+    @instrumentation.command
     def get_STAT(self, group_name, id):
-        meta_table = self.get_table_name(table_name='newsgroup_meta')
-        stmt = """
-                SELECT
-                    article_number
-                FROM
-                    %s
-                WHERE
-                    newsgroup='%s' AND
-                    article_number=%s""" % (meta_table, group_name, id)
-        return self.cursor.execute(stmt)
+        return self.get_article_index(group_name).count(int(id), int(id))
 
+    @instrumentation.command
     def get_ARTICLE(self, group_name, id, headers_only=False, body_only=False):
-        stmt = self.get_article_sql()
-        if str(id).count('<') > 0 or str(id).count('@') > 0:
-            id = self.quote_string(id)
-            stmt += " AND message_id='%s'" % (id,)
+        article = self.load_article(group_name, id)
+        if article is None:
+            return None
+        return self.format_article(article, headers_only, body_only)
+
+    def load_article(self, group_name, id):
+        """Does the database half of ARTICLE: returns (cache key, row,
+        headers, body), with body None when it still has to be rendered,
+        or None if there is no such article.  Articles in the shared spool
+        (see wp_spool_file) come back as (None, None, headers, body),
+        after a primary key lookup of their version unless wp_spool_verify
+        is off.
+        """
+        meta = self.get_article_meta(group_name, id)
+        if meta is None:
+            return None
+        spooled = self.get_spooled_article(meta)
+        if spooled is not None:
+            return (None, None, spooled[0], spooled[1])
+        # a Message-ID may belong to another group
+        group_name = meta[3]
+        if meta[2] == self.get_table_name(group_name, 'comments'):
+            stmt, args = self.get_article_sql(group_name, "A.comment_ID=%s", (meta[1],), meta[2])
         else:
-            id = int(id)
-            stmt += " AND article_number=%s" % (id,)
-        num_rows = self.cursor.execute(stmt)
+            stmt, args = self.get_article_sql(group_name, "T.ID=%s", (meta[1],), meta[2])
+        num_rows = self.cursor.execute(stmt, args)
         if num_rows == 0:
             return None
         result = list(self.cursor.fetchone())
-        if not body_only:
-            if len(result[3]) == 0:
-                author = result[2]
-            else:
-                author = "%s <%s>" % (result[2], result[3])
-            formatted_time = strutil.get_formatted_time(time.localtime(result[5]))
-            headers = []
-            headers.append("Path: %s" % (settings.nntp_hostname))
-            headers.append("From: %s" % (author))
-            headers.append("Newsgroups: %s" % (group_name))
-            headers.append("Date: %s" % (formatted_time))
-            headers.append("Subject: %s" % (result[4]))
-            headers.append("Message-ID: %s" % (result[9]))
-            headers.append("Xref: %s %s:%s" % (settings.nntp_hostname, group_name, result[0]))
-            parent = []
-            if result[7] != 0:
-                parent.append(self.get_message_id(result[7], group_name, 'posts'))
-            if result[8] != 0:
-                parent.append(self.get_message_id(result[8], group_name, 'comments'))
-            if len(parent) > 0:
-                headers.append("References: " + ', '.join(parent))
-                headers.append("In-Reply-To: " + parent.pop())
-            headers.append('Content-Type: text/plain; charset=utf-8')
-        if headers_only:
-            return "\r\n".join(headers)
-        if html2text:
-            body = html2text.html2text(result[6].encode('utf-8').replace("\r\n", "\n").replace("\r", "\n").replace("\n\n", "</p><p>")).encode('utf-8')
+        key = (group_name, result[0], result[12])
+        cached = article_cache.get(key)
+        if cached is None:
+            return (key, result, self.get_article_headers(group_name, result), None)
+        return (key, result, cached[0], cached[1])
+
+    def get_spooled_article(self, meta):
+        """Returns (headers, body) of a get_article_meta() article from the
+        spool if it is there at its current version, else None.
+        """
+        if not spool.enabled():
+            return None
+        if not getattr(settings, 'wp_spool_verify', True):
+            return spool.get(meta[0])
+        version = self.get_article_version(meta)
+        if version is None:
+            return None
+        return spool.get(meta[0], version)
+
+    def get_article_version(self, meta):
+        """Returns the current version of a get_article_meta() article, as
+        get_article_sql() computes it, or None if it is no longer visible.
+        """
+        if meta[2].endswith('comments'):
+            stmt = self.prepare("""
+                    SELECT
+                        CRC32(A.comment_content)
+                    FROM
+                        wp_comments A, wp_posts T
+                    WHERE
+                        A.comment_ID=%s AND A.comment_approved='1' AND
+                        T.ID=A.comment_post_ID AND T.post_type='post' AND T.post_status='publish'""", meta[3])
         else:
-            body = strutil.format_body(result[6].encode('utf-8'))
+            stmt = self.prepare("""
+                    SELECT
+                        UNIX_TIMESTAMP(post_modified_gmt)
+                    FROM
+                        wp_posts
+                    WHERE
+                        ID=%s AND post_type='post' AND post_status='publish'""", meta[3])
+        if self.cursor.execute(stmt, (meta[1],)) == 0:
+            return None
+        return self.cursor.fetchone()[0]
+
+    def format_article(self, article, headers_only=False, body_only=False):
+        """Does the rendering half of ARTICLE on a load_article() result."""
+        key, row, headers, body = article
+        if headers_only:
+            return headers
+        if body is None:
+            body = self.get_body(row)
+            article_cache.put(key, (headers, body), len(headers) + len(body))
+            spool.put(row[0], row[12], headers, body)
         if body_only:
             return body
-        return ("\r\n".join(headers).encode('utf-8'), body)
+        return (headers.encode('utf-8'), body)
 
+    def get_article_headers(self, group_name, row):
+        """Builds the article headers of a get_article_sql() row."""
+        author = self.get_author(row)
+        formatted_time = strutil.get_formatted_time(time.localtime(row[5]))
+        headers = []
+        headers.append("Path: %s" % (settings.nntp_hostname))
+        headers.append("From: %s" % (author))
+        headers.append("Newsgroups: %s" % (group_name))
+        headers.append("Date: %s" % (formatted_time))
+        headers.append("Subject: %s" % (row[4]))
+        headers.append("Message-ID: %s" % (row[9]))
+        headers.append("Xref: %s %s:%s" % (settings.nntp_hostname, group_name, row[0]))
+        refs = self.get_references(row)
+        if len(refs) > 0:
+            headers.append("References: " + ' '.join(refs))
+            headers.append("In-Reply-To: " + refs[-1])
+        headers.append('Content-Type: text/plain; charset=utf-8')
+        return "\r\n".join(headers)
+
+    @instrumentation.command
     def get_LAST(self, group_name, current_id):
-        meta_table = self.get_table_name(table_name='newsgroup_meta')
-        stmt = """
-               SELECT
-                   article_number
-               FROM
-                   %s
-               WHERE
-                   newsgroup='%s' AND article_number < %s
-               ORDER BY
-                   ID DESC
-               LIMIT 0, 1
-               """ % (meta_table, group_name, current_id)
-        num_rows = self.cursor.execute(stmt)
-        if num_rows == 0:
-            return None
-        return self.cursor.fetchone()[0]
+        return self.get_article_index(group_name).previous(int(current_id))
 
+    @instrumentation.command
     def get_NEXT(self, group_name, current_id):
-        meta_table = self.get_table_name(table_name='newsgroup_meta')
-        stmt = """
-               SELECT
-                   article_number
-               FROM
-                   %s
-               WHERE
-                   newsgroup='%s' AND article_number > %s
-               ORDER BY
-                   ID ASC
-               LIMIT 0, 1
-               """ % (meta_table, group_name, current_id)
-        num_rows = self.cursor.execute(stmt)
-        if num_rows == 0:
-            return None
-        return self.cursor.fetchone()[0]
+        return self.get_article_index(group_name).next(int(current_id))
 
+    @instrumentation.command
     def get_HEAD(self, group_name, id):
         return self.get_ARTICLE(group_name, id, headers_only=True)
 
+    @instrumentation.command
     def get_BODY(self, group_name, id):
         return self.get_ARTICLE(group_name, id, body_only=True)
 
+    @instrumentation.command
     def get_XOVER(self, group_name, start_id, end_id='ggg'):
-        self.update_newsgroup_meta()
-        stmt = self.get_article_sql()
-        stmt += " AND article_number >= %s" % (start_id,)
-        if end_id != 'ggg':
-            stmt += " AND article_number <= %s" % (end_id,)
-        self.cursor.execute(stmt)
-        result = list(self.cursor.fetchall())
-        overviews = []
-        for row in result:
-            if html2text:
-                body = html2text.html2text(row[6].encode('utf-8')).encode('utf-8')
-            else:
-                body = strutil.format_body(row[6].encode('utf-8'))
-            if row[3] == '':
-                author = row[2]
-            else:
-                author = "%s <%s>" % (row[2], row[3])
-            formatted_time = strutil.get_formatted_time(time.localtime(row[5]))
-            message_id = row[9]
-            line_count = body.count("\n")
-            xref = 'Xref: %s %s:%s' % (settings.nntp_hostname, group_name, row[0])
-            parent = []
-            if row[7] != 0:
-                parent.append(self.get_message_id(row[7], group_name, 'posts'))
-            if row[8] != 0:
-                parent.append(self.get_message_id(row[8], group_name, 'comments'))
-            reference = ', '.join(parent)
-            # message_number <tab> subject <tab> author <tab> date <tab> message_id <tab> reference <tab> bytes <tab> lines <tab> xref
-            overviews.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (row[0], row[4], author, formatted_time, message_id, reference, len(body), line_count, xref))
-        return "\r\n".join(overviews)
+        return "\r\n".join(self.iter_XOVER(group_name, start_id, end_id))
 
-    def get_XPAT(self, group_name, header, pattern, start_id, end_id='ggg'):
-        return None # TODO: really broken
-        # XXX: need to actually check for the header values being passed as
-        # XXX: not all header names map to column names on the tables
-        table_name = self.get_table_name(group_name)
+    def iter_XOVER(self, group_name, start_id, end_id='ggg'):
+        """Yields the XOVER response in chunks of lines joined by CRLF."""
+        self.request_sync()
+        if end_id == 'ggg':
+            end_id = None
+        stmt, args = self.get_overview_sql(group_name, overview_fields, start_id, end_id)
+        for rows in self.stream_query(stmt, args):
+            overviews = []
+            for row in rows:
+                xref = 'Xref: %s %s:%s' % (settings.nntp_hostname, group_name, row[0])
+                # message_number <tab> subject <tab> author <tab> date <tab> message_id <tab> reference <tab> bytes <tab> lines <tab> xref
+                overviews.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (tuple(row) + (xref,)))
+            yield "\r\n".join(overviews)
+
+    def is_message_id(self, id):
+        return str(id).count('<') > 0 or str(id).count('@') > 0
+
+    def get_group_number(self, group_name, message_id):
+        """Returns the number of message_id in group_name, or None."""
+        meta = self.get_article_meta(group_name, message_id)
+        if meta is None or meta[3] != group_name:
+            return None
+        return meta[0]
+
+    def get_overview_sql(self, group_name, columns, start_id, end_id=None, where=None, args=()):
+        """Returns the query selecting article_number and columns from the
+        overview rows of group_name numbered start_id to end_id (open ended
+        when end_id is None), optionally narrowed by an extra where clause
+        with %s placeholders for args, and the arguments to run it with.
+        """
         stmt = """
                 SELECT
-                    A.ID,
-                    post_parent,
-                    display_name,
-                    user_email,
-                    post_title,
-                    UNIX_TIMESTAMP(post_date_gmt) AS datestamp,
-                    post_content
+                    """ + ', '.join(('article_number',) + tuple(columns)) + """
                 FROM
-                    %s A, 
-                    wp_users
+                    wp_newsgroup_overview
                 WHERE
-                    A.post_type='post' AND A.post_status='publish' AND
-                    %s REGEXP '%s' AND
-                    post_author = wp_users.ID AND
-                    A.ID >= %s""" % (table_name, header, strutil.format_wildcards(pattern), start_id)
-        if end_id != 'ggg':
-            stmt = "%s AND A.id <= %s" % (stmt, end_id)
-        num_rows = self.cursor.execute(stmt)
-        if num_rows == 0:
+                    newsgroup=%s AND article_number >= %s"""
+        args = (group_name, int(start_id)) + tuple(args)
+        if end_id is not None:
+            stmt += " AND article_number <= %s"
+            args += (int(end_id),)
+        if where:
+            stmt += " AND " + where
+        return self.prepare(stmt + " ORDER BY article_number"), args
+
+    @instrumentation.command
+    def get_XPAT(self, group_name, header, pattern, start_id, end_id='ggg'):
+        return self.join_header_chunks(list(self.iter_XPAT(group_name, header, pattern, start_id, end_id)))
+
+    def iter_XPAT(self, group_name, header, pattern, start_id, end_id='ggg'):
+        """Yields the XPAT response in chunks, one per batch of articles
+        scanned (a chunk is empty when none of its articles matched).
+
+        Simple patterns are handed to MySQL as a LIKE, which uses the
+        (newsgroup, subject) and (newsgroup, author) indexes when the
+        pattern starts with a literal prefix; every value is still checked
+        against the wildmat here, as LIKE ignores case.
+        """
+        self.request_sync()
+        if end_id == 'ggg':
+            end_id = None
+        if self.is_message_id(start_id):
+            # the Message-ID form asks about that one article
+            start_id = end_id = self.get_group_number(group_name, start_id)
+            if start_id is None:
+                return
+        column = overview_columns.get(header.upper())
+        columns = ()
+        where = None
+        args = ()
+        if column is not None:
+            columns = (column,)
+            like = wildmat_like(pattern)
+            if like is not None:
+                where = column + " LIKE %s"
+                args = (like,)
+        stmt, args = self.get_overview_sql(group_name, columns, start_id, end_id, where, args)
+        for rows in self.stream_query(stmt, args):
+            hdrs = []
+            for row in rows:
+                if header.upper() == 'XREF':
+                    value = '%s %s:%s' % (settings.nntp_hostname, group_name, row[0])
+                elif column is not None and row[1] is not None:
+                    value = '%s' % (row[1],)
+                else:
+                    continue
+                if wildmat(pattern, value):
+                    hdrs.append('%s %s' % (row[0], value))
+            yield "\r\n".join(hdrs)
+
+    @instrumentation.command
+    def get_XSEARCH(self, group_name, query, offset=0, limit=None):
+        """Returns the numbers of the articles whose subject or body match
+        query, newest first, one per line; None for an unknown group.
+
+        query is a MySQL boolean mode FULLTEXT search (word, +word, -word,
+        "a phrase", prefix*).  Results come limit at a time (default
+        wp_search_limit) starting at offset, so a client pages through a
+        large result instead of receiving all of it.
+        """
+        if not self.group_exists(group_name):
             return None
-        result = list(self.cursor.fetchall())
-        hdrs = []
-        for row in result:
-            if header.upper() == 'SUBJECT':
-                hdrs.append('%s %s' % (row[0], row[4]))
-            elif header.upper() == 'FROM':
-                # XXX: totally broken with empty values for the email address
-                hdrs.append('%s %s <%s>' % (row[0], row[2], row[3]))
-            elif header.upper() == 'DATE':
-                hdrs.append('%s %s' % (row[0], strutil.get_formatted_time(time.localtime(result[5]))))
-            elif header.upper() == 'MESSAGE-ID':
-                hdrs.append(row[0] + ' ' + self.get_message_id(row[0], group_name))
-            elif (header.upper() == 'REFERENCES') and (row[1] != 0):
-                hdrs.append(row[0] + ' ' + self.message_id(row[1], group_name))
-            elif header.upper() == 'BYTES':
-                hdrs.append('%s %s' % (row[0], len(row[6])))
-            elif header.upper() == 'LINES':
-                hdrs.append('%s %s' % (row[0], len(row[6].split('\n'))))
-            elif header.upper() == 'XREF':
-                hdrs.append('%s %s %s:%s' % (row[0], settings.nntp_hostname, group_name, row[0]))
-        if len(hdrs) == 0:
-            return ""
-        else:
-            return "\r\n".join(hdrs)
+        self.request_sync()
+        if limit is None:
+            limit = getattr(settings, 'wp_search_limit', 100)
+        if len(query.strip()) == 0:
+            return ''
+        stmt = self.prepare("""
+               SELECT
+                   article_number
+               FROM
+                   wp_newsgroup_search
+               WHERE
+                   MATCH (subject, body) AGAINST (%s IN BOOLEAN MODE) AND
+                   newsgroup=%s
+               ORDER BY
+                   article_number DESC
+               LIMIT %s, %s
+               """)
+        self.cursor.execute(stmt, (query, group_name, int(offset), int(limit)))
+        return "\r\n".join(["%s" % row[0] for row in self.cursor.fetchall()])
 
+    @instrumentation.command
     def get_LISTGROUP(self, group_name):
-        self.update_newsgroup_meta()
-        meta_table = self.get_table_name(table_name='newsgroup_meta')
-        stmt = """
+        return "\r\n".join(self.iter_LISTGROUP(group_name))
+
+    def iter_LISTGROUP(self, group_name):
+        self.request_sync()
+        stmt = self.prepare("""
                SELECT
                    article_number
                FROM
-                   %s
+                   wp_newsgroup_meta
                WHERE
-                   newsgroup='%s'
-               """ % (meta_table, group_name)
-        self.cursor.execute(stmt)
-        result = list(self.cursor.fetchall())
-        return "\r\n".join(["%s" % k for k in result])
+                   newsgroup=%s
+               ORDER BY
+                   article_number
+               """)
+        for rows in self.stream_query(stmt, (group_name,)):
+            yield "\r\n".join(["%s" % k for k in rows])
 
+    @instrumentation.command
     def get_XGTITLE(self, pattern=None):
-        return "blog.singpolyma Singpolyma" # TODO
+        titles = []
+        for group_name, group in sorted(self.get_groups().items()):
+            if pattern is None or wildmat(pattern, group_name):
+                titles.append("%s %s" % (group_name, group['description']))
+        return "\r\n".join(titles)
 
+    @instrumentation.command
     def get_XHDR(self, group_name, header, style, range):
-        self.update_newsgroup_meta()
-        stmt = self.get_article_sql()
+        return self.join_header_chunks(list(self.iter_XHDR(group_name, header, style, range)))
 
-        if style == 'range':
-            stmt += ' AND article_number >= %s' % (range[0],)
-            if len(range) == 2:
-                stmt += ' AND article_number <= %s' % (range[1])
-        else:
-            stmt += ' AND article_number = %s' % (range[0],)
-        if self.cursor.execute(stmt) == 0:
+    def join_header_chunks(self, chunks):
+        """Joins iter_XHDR/iter_XPAT chunks; None if no article was found."""
+        if len(chunks) == 0:
             return None
-        result = self.cursor.fetchall()
-        hdrs = []
-        for row in result:
-            parent = []
-            if row[7] != 0:
-                parent.append(self.get_message_id(row[7], group_name, 'posts'))
-            if row[8] != 0:
-                parent.append(self.get_message_id(row[8], group_name, 'comments'))
-            if header.upper() == 'SUBJECT':
-                hdrs.append('%s %s' % (row[0], row[4]))
-            elif header.upper() == 'FROM':
-                hdrs.append('%s %s <%s>' % (row[0], row[2], row[3]))
-            elif header.upper() == 'DATE':
-                hdrs.append('%s %s' % (row[0], strutil.get_formatted_time(time.localtime(result[5]))))
-            elif header.upper() == 'MESSAGE-ID':
-                hdrs.append(row[0] + ' ' + row[9])
-            elif (header.upper() == 'REFERENCES') and len(parent) > 0:
-                hdrs.append('%s %s' % (row[0], ', '.join(parent)))
-            elif header.upper() == 'BYTES':
-                hdrs.append('%s %s' % (row[0], len(row[6])))
-            elif header.upper() == 'LINES':
-                hdrs.append('%s %s' % (row[0], len(row[6].split('\n'))))
-            elif header.upper() == 'XREF':
-                hdrs.append('%s %s %s:%s' % (row[0], settings.nntp_hostname, group_name, row[0]))
-        if len(hdrs) == 0:
-            return ""
+        return "\r\n".join([chunk for chunk in chunks if chunk != ""])
+
+    def iter_XHDR(self, group_name, header, style, range):
+        """Yields the XHDR response in chunks, one per batch of articles
+        found (a chunk is empty when none of its articles has the header).
+        Only the overview column holding the header is read.
+        """
+        self.request_sync()
+        if style == 'range':
+            start_id = range[0]
+            end_id = len(range) == 2 and range[1] or None
+        elif self.is_message_id(range[0]):
+            start_id = end_id = self.get_group_number(group_name, range[0])
+            if start_id is None:
+                return
         else:
-            return "\r\n".join(hdrs)
+            start_id = end_id = range[0]
+        column = overview_columns.get(header.upper())
+        columns = column is not None and (column,) or ()
+        stmt, args = self.get_overview_sql(group_name, columns, start_id, end_id)
+        for rows in self.stream_query(stmt, args):
+            hdrs = []
+            for row in rows:
+                if header.upper() == 'XREF':
+                    hdrs.append('%s %s %s:%s' % (row[0], settings.nntp_hostname, group_name, row[0]))
+                elif column is not None and row[1] not in ('', None):
+                    hdrs.append('%s %s' % (row[0], row[1]))
+            yield "\r\n".join(hdrs)
 
+    @instrumentation.command
     def do_POST(self, group_name, lines, ip_address, username=''):
-        return None # TODO, below code from other engine, just for reference
-        table_name = self.get_table_name(group_name)
+        """Posts a reply as a comment on the blog; returns 1 or None."""
+        return self.do_POST_batch([(group_name, lines, ip_address, username)])[0]
+
+    @instrumentation.command
+    def do_POST_batch(self, posts):
+        """Posts several (group_name, lines, ip_address, username) replies
+        in one transaction, returning 1 or None for each.
+
+        Only replies can be posted: the last Message-ID of References (or
+        In-Reply-To) names the post or comment answered, which must be in
+        the group's blog and open for comments.  Each comment is inserted
+        with its wp_newsgroup_meta row (when approved, see
+        wp_post_approved), so it is numbered at once; a post that fails is
+        rolled back to its savepoint without losing the rest of the batch.
+        """
+        started = time.time()
+        results = []
+        committed = False
+        try:
+            self.cursor.execute("START TRANSACTION")
+            for group_name, lines, ip_address, username in posts:
+                results.append(self.ingest_post(group_name, lines, ip_address, username))
+            self.conn.commit()
+            committed = True
+        except MySQLdb.Error:
+            log.exception('posting a batch of %s failed', len(posts))
+            post_stats.record(0, 0, len(posts), time.time() - started)
+            return [None] * len(posts)
+        finally:
+            # the pooled connection must not be left inside the transaction
+            if not committed:
+                self.conn.rollback()
+        posted = len([result for result in results if result is not None])
+        post_stats.record(posted, len(posts) - posted, 0, time.time() - started)
+        if posted:
+            self.update_article_indexes()
+        return results
+
+    def ingest_post(self, group_name, lines, ip_address, username):
+        """Posts one reply inside do_POST_batch()'s transaction; anything
+        it did is rolled back to its savepoint if it fails.
+        """
+        self.cursor.execute("SAVEPOINT post")
+        try:
+            post = self.parse_post(group_name, lines, username)
+            if post is None:
+                return None
+            self.insert_comment(group_name, post, ip_address)
+        except Exception:
+            log.exception('posting to %s failed', group_name)
+            self.cursor.execute("ROLLBACK TO SAVEPOINT post")
+            return None
+        return 1
+
+    def parse_post(self, group_name, lines, username):
+        """Returns the comment fields of a posted article, or None if it
+        cannot become a comment.
+        """
+        if not self.group_exists(group_name):
+            return None
+        message = message_from_string(lines)
+        references = re.findall(r'<[^<>\s]+>', message.get('References', '') or message.get('In-Reply-To', ''))
+        if len(references) == 0:
+            return None
+        parent = self.get_post_parent(group_name, references[-1])
+        if parent is None:
+            return None
+        name, address = parseaddr(mime_decode_header(re.sub(q_quote_multiline, "=?\\1?Q?\\2\\3?=", message.get('From', ''))))
+        user_id = 0
+        if username:
+            self.cursor.execute(self.prepare("SELECT ID, display_name, user_email FROM wp_users WHERE user_login=%s"), (username,))
+            user = self.cursor.fetchone()
+            if user is not None:
+                user_id, name, address = user
+        if user_id == 0 and self.get_blog_option(group_name, 'comment_registration') == '1':
+            # the blog only takes comments from registered users
+            return None
         body = self.get_message_body(lines)
-        author, email = from_regexp.search(lines, 0).groups()
-        subject = subject_regexp.search(lines, 0).groups()[0].strip()
-        # patch by Andreas Wegmann <Andreas.Wegmann@VSA.de> to fix the handling of unusual encodings of messages
-        lines = mime_decode_header(re.sub(q_quote_multiline, "=?\\1?Q?\\2\\3?=", lines))
-        if lines.find('References') != -1:
-            # get the 'modifystamp' value from the parent (if any)
-            references = references_regexp.search(lines, 0).groups()
-            parent_id, void = references[-1].strip().split('@')
-            stmt = """
-                    SELECT
-                        IF(MAX(id) IS NULL, 1, MAX(id)+1) AS next_id
-                    FROM
-                        %s""" % (table_name)
-            num_rows = self.cursor.execute(stmt)
-            if num_rows == 0:
-                new_id = 1
-            else:
-                new_id = self.cursor.fetchone()[0]
-            stmt = """
+        if not isinstance(body, type(u'')):
+            try:
+                body = body.decode('utf-8')
+            except UnicodeDecodeError:
+                body = body.decode('latin-1')
+        if not (name or address) or len(body.strip()) == 0:
+            return None
+        return {'post_id': parent[0], 'parent': parent[1], 'author': name or address,
+                'email': address, 'content': body.strip(), 'user_id': user_id}
+
+    def get_blog_option(self, group_name, name):
+        """Returns a wp_options value of group_name's blog, or None."""
+        stmt = self.prepare("SELECT option_value FROM wp_options WHERE option_name=%s", group_name)
+        if self.cursor.execute(stmt, (name,)) == 0:
+            return None
+        return self.cursor.fetchone()[0]
+
+    def get_post_parent(self, group_name, message_id):
+        """Maps the Message-ID being answered to (comment_post_ID,
+        comment_parent), or None if it cannot be commented on.
+        """
+        meta = self.get_article_meta(group_name, message_id)
+        if meta is None or self.require_group(meta[3])['prefix'] != self.require_group(group_name)['prefix']:
+            return None
+        if meta[2].endswith('comments'):
+            stmt = self.prepare("""
                     SELECT
-                        id,
-                        thread,
-                        modifystamp
+                        c.comment_post_ID
                     FROM
-                        %s
+                        wp_comments c, wp_posts p
                     WHERE
-                        approved='Y' AND
-                        id=%s
-                    GROUP BY
-                        id""" % (table_name, parent_id)
-            num_rows = self.cursor.execute(stmt)
-            if num_rows == 0:
+                        c.comment_ID=%s AND c.comment_approved='1' AND
+                        p.ID=c.comment_post_ID AND p.comment_status='open'""", group_name)
+            if self.cursor.execute(stmt, (meta[1],)) == 0:
                 return None
-            parent_id, thread_id, modifystamp = self.cursor.fetchone()
-        else:
-            stmt = """
-                    SELECT
-                        IF(MAX(id) IS NULL, 1, MAX(id)+1) AS next_id,
-                        UNIX_TIMESTAMP()
-                    FROM
-                        %s""" % (table_name)
-            self.cursor.execute(stmt)
-            new_id, modifystamp = self.cursor.fetchone()
-            parent_id = 0
-            thread_id = new_id
-        stmt = """
-                INSERT INTO
-                    %s
-                (
-                    id,
-                    datestamp,
-                    thread,
-                    parent,
-                    author,
-                    subject,
-                    email,
-                    host,
-                    email_reply,
-                    approved,
-                    msgid,
-                    modifystamp,
-                    userid
-                ) VALUES (
-                    %s,
-                    NOW(),
-                    %s,
-                    %s,
-                    '%s',
-                    '%s',
-                    '%s',
-                    '%s',
-                    'N',
-                    'Y',
-                    '',
-                    %s,
-                    0
-                )
-                """ % (table_name, new_id, thread_id, parent_id, self.quote_string(author.strip()), self.quote_string(subject), self.quote_string(email), ip_address, modifystamp)
-        if not self.cursor.execute(stmt):
+            return (self.cursor.fetchone()[0], meta[1])
+        stmt = self.prepare("SELECT ID FROM wp_posts WHERE ID=%s AND comment_status='open'", group_name)
+        if self.cursor.execute(stmt, (meta[1],)) == 0:
             return None
-        else:
-            # insert into the '*_bodies' table
-            stmt = """
-                    INSERT INTO
-                        %s_bodies
-                    (
-                        id,
-                        body,
-                        thread
-                    ) VALUES (
-                        %s,
-                        '%s',
-                        %s
-                    )""" % (table_name, new_id, self.quote_string(body), thread_id)
-            if not self.cursor.execute(stmt):
-                # delete from 'table_name' before returning..
-                stmt = """
-                        DELETE FROM
-                            %s
-                        WHERE
-                            id=%s""" % (table_name, new_id)
-                self.cursor.execute(stmt)
-                return None
+        return (meta[1], 0)
+
+    def insert_comment(self, group_name, post, ip_address):
+        """Inserts a parse_post() comment and, if it is approved, its meta
+        row and the post's comment count.  Returns the new comment_ID.
+        """
+        approved = getattr(settings, 'wp_post_approved', '0')
+        stmt = self.prepare("""
+                INSERT INTO wp_comments
+                    (comment_post_ID, comment_author, comment_author_email,
+                     comment_author_IP, comment_date, comment_date_gmt,
+                     comment_content, comment_approved, comment_agent,
+                     comment_parent, user_id)
+                VALUES (%s, %s, %s, %s, NOW(), UTC_TIMESTAMP(), %s, %s, 'papercut', %s, %s)
+               """, group_name)
+        self.cursor.execute(stmt, (post['post_id'], post['author'], post['email'], ip_address,
+                                   post['content'], approved, post['parent'], post['user_id']))
+        comment_id = self.cursor.lastrowid
+        if approved != '1':
+            return comment_id
+        # dated from comment_date_gmt, as the sync numbers comments
+        stmt = self.prepare("""
+                INSERT INTO wp_newsgroup_meta (id, tbl, message_id, newsgroup, datestamp)
+                SELECT comment_ID, 'wp_comments', %s, %s, UNIX_TIMESTAMP(comment_date_gmt)
+                FROM wp_comments WHERE comment_ID=%s
+               """, group_name)
+        self.cursor.execute(stmt, ('<comment-%s@%s>' % (comment_id, self.require_group(group_name)['host']), group_name, comment_id))
+        stmt = self.prepare("UPDATE wp_posts SET comment_count=comment_count+1 WHERE ID=%s", group_name)
+        self.cursor.execute(stmt, (post['post_id'],))
+        return comment_id
+
+
+class Cancelled(Exception):
+    """Raised by Future.result() for work that was cancelled."""
+
+class TimedOut(Exception):
+    """Raised by Future.result() when the timeout passes first."""
+
+class Future:
+    """
+    Result of a call handed to a WorkerPool
+
+    A server loop can block in result() or register add_done_callback(),
+    which runs in the worker thread (or at once if the future is already
+    done).  cancel() drops work that has not started; work already running
+    may check cancelled() and stop early, its result is discarded.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.state = 'pending'
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def start(self):
+        """Marks the work as running; False if it was cancelled first."""
+        self.condition.acquire()
+        try:
+            if self.state != 'pending':
+                return False
+            self.state = 'running'
+            return True
+        finally:
+            self.condition.release()
+
+    def cancel(self):
+        return self.finish('cancelled', None, None)
+
+    def set_result(self, value):
+        self.finish('done', value, None)
+
+    def set_error(self, error):
+        self.finish('done', None, error)
+
+    def finish(self, state, value, error):
+        self.condition.acquire()
+        try:
+            if self.state in ('done', 'cancelled'):
+                return False
+            self.state = state
+            self.value = value
+            self.error = error
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        for callback in callbacks:
+            self.run_callback(callback)
+        return True
+
+    def run_callback(self, callback):
+        # a failing callback must not take the worker thread down with it
+        try:
+            callback(self)
+        except Exception:
+            log.exception('future callback %r failed', callback)
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def done(self):
+        return self.state in ('done', 'cancelled')
+
+    def add_done_callback(self, callback):
+        self.condition.acquire()
+        try:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.condition.release()
+        self.run_callback(callback)
+
+    def result(self, timeout=None):
+        self.condition.acquire()
+        try:
+            if not self.done():
+                self.condition.wait(timeout)
+            if not self.done():
+                raise TimedOut()
+        finally:
+            self.condition.release()
+        if self.state == 'cancelled':
+            raise Cancelled()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class WorkerPool:
+    """
+    Fixed number of daemon threads running submitted calls in order
+
+    The threads are started on the first submit().  size bounds how many
+    calls run at once; the rest wait in the queue.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.queue = queue.Queue()
+        self.threads = []
+        self.spawned = 0
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def submit(self, function, args=(), future=None):
+        """Queues function(*args); returns the Future it will resolve."""
+        if future is None:
+            future = Future()
+        if len([thread for thread in self.threads if thread.is_alive()]) < self.size:
+            self.lock.acquire()
+            try:
+                # replace any worker that died
+                self.threads = [thread for thread in self.threads if thread.is_alive()]
+                while len(self.threads) < self.size:
+                    self.spawned += 1
+                    thread = threading.Thread(target=self.run, name='%s-%s' % (self.name, self.spawned))
+                    thread.setDaemon(True)
+                    thread.start()
+                    self.threads.append(thread)
+            finally:
+                self.lock.release()
+        self.submitted += 1
+        self.queue.put((future, function, args))
+        return future
+
+    def run(self):
+        while True:
+            future, function, args = self.queue.get()
+            if not future.start():
+                self.skipped += 1
+                continue
+            try:
+                value = function(*args)
+            except Exception as e:
+                self.failed += 1
+                future.set_error(e)
             else:
-                # alert forum moderators
-                self.send_notifications(group_name, new_id, thread_id, parent_id, author.strip(), email, subject, body)
-                return 1
+                self.completed += 1
+                future.set_result(value)
+
+    def stats(self):
+        return {'threads': len(self.threads), 'size': self.size,
+                'queued': self.queue.qsize(), 'submitted': self.submitted,
+                'completed': self.completed, 'failed': self.failed,
+                'skipped': self.skipped}
+
+db_workers = WorkerPool('wp-db', getattr(settings, 'wp_async_db_threads', min(4, pool.size)))
+render_workers = WorkerPool('wp-render', getattr(settings, 'wp_async_render_threads', 2))
+
+class AsyncStorage:
+    """
+    Non-blocking facade over a Papercut_Storage
+
+    Every command method (get_GROUP, get_XOVER, do_POST, ...) takes the
+    same arguments as the storage's and returns a Future at once.  Queries
+    run on db_workers and body rendering on render_workers, so neither a
+    slow range scan nor a large render holds up the caller; an ARTICLE
+    moves from one pool to the other once its row is loaded.  close(),
+    e.g. when the client disconnects, cancels what is still outstanding;
+    streamed commands stop at their next chunk.
+    """
+
+    def __init__(self, storage=None):
+        if storage is None:
+            storage = Papercut_Storage()
+        self.storage = storage
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def track(self, future):
+        self.lock.acquire()
+        try:
+            self.futures[id(future)] = future
+        finally:
+            self.lock.release()
+        future.add_done_callback(self.forget)
+        return future
+
+    def forget(self, future):
+        self.lock.acquire()
+        try:
+            self.futures.pop(id(future), None)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Cancels every outstanding call of this session."""
+        self.lock.acquire()
+        try:
+            futures = list(self.futures.values())
+        finally:
+            self.lock.release()
+        for future in futures:
+            future.cancel()
+
+    def __getattr__(self, name):
+        if not (name.startswith('get_') or name.startswith('do_')):
+            raise AttributeError(name)
+        method = getattr(self.storage, name)
+        def submit(*args, **kwargs):
+            return self.track(db_workers.submit(lambda: method(*args, **kwargs)))
+        return submit
+
+    def get_ARTICLE(self, group_name, id, headers_only=False, body_only=False):
+        return self.article('ARTICLE', group_name, id, headers_only, body_only)
+
+    def get_HEAD(self, group_name, id):
+        return self.article('HEAD', group_name, id, headers_only=True)
+
+    def get_BODY(self, group_name, id):
+        return self.article('BODY', group_name, id, body_only=True)
+
+    def article(self, name, group_name, id, headers_only=False, body_only=False):
+        # instrumented as one command, like the storage's own get_ARTICLE
+        record = instrumentation.begin(name, self.storage, (group_name, id))
+        future = self.track(Future())
+        future.add_done_callback(lambda future: instrumentation.end(record, (group_name, id), future))
+        def loaded(loading):
+            if loading.cancelled():
+                future.cancel()
+                return
+            try:
+                article = loading.result()
+            except Exception as e:
+                future.set_error(e)
+                return
+            if article is None:
+                future.set_result(None)
+            elif headers_only or article[3] is not None or article[1][15] is not None:
+                # nothing to render
+                try:
+                    formatted = pool.run(instrumentation.call, record, self.storage.format_article, article, headers_only, body_only)
+                except Exception as e:
+                    future.set_error(e)
+                    return
+                future.set_result(formatted)
+            else:
+                render_workers.submit(pool.run, (instrumentation.call, record, self.storage.format_article, article, headers_only, body_only), future)
+        loading = db_workers.submit(pool.run, (instrumentation.call, record, self.storage.load_article, group_name, id))
+        future.add_done_callback(lambda future: future.cancelled() and loading.cancel())
+        loading.add_done_callback(loaded)
+        return future
+
+    def stream(self, name, args, chunks, join):
+        """Runs a storage iter_* generator on db_workers, checking for
+        cancellation between chunks, and resolves to join(chunks); it is
+        instrumented as the command name.
+        """
+        record = instrumentation.begin(name, self.storage, args)
+        future = Future()
+        future.add_done_callback(lambda future: instrumentation.end(record, args, future))
+        def collect():
+            collected = []
+            try:
+                for chunk in chunks:
+                    if future.cancelled():
+                        return None
+                    collected.append(chunk)
+            finally:
+                # closes the server side cursor of a stopped scan
+                chunks.close()
+            return join(collected)
+        return self.track(db_workers.submit(pool.run, (instrumentation.call, record, collect), future))
+
+    def get_XOVER(self, group_name, start_id, end_id='ggg'):
+        return self.stream('XOVER', (group_name, start_id, end_id),
+                           self.storage.iter_XOVER(group_name, start_id, end_id), "\r\n".join)
+
+    def get_XHDR(self, group_name, header, style, range):
+        return self.stream('XHDR', (group_name, header, style, range),
+                           self.storage.iter_XHDR(group_name, header, style, range), self.storage.join_header_chunks)
+
+    def get_XPAT(self, group_name, header, pattern, start_id, end_id='ggg'):
+        return self.stream('XPAT', (group_name, header, pattern, start_id, end_id),
+                           self.storage.iter_XPAT(group_name, header, pattern, start_id, end_id),
+                           self.storage.join_header_chunks)
+
+    def get_LISTGROUP(self, group_name):
+        return self.stream('LISTGROUP', (group_name,), self.storage.iter_LISTGROUP(group_name), "\r\n".join)
+
+    def get_NEWNEWS(self, ts, group='*'):
+        return self.stream('NEWNEWS', (ts, group), self.storage.iter_NEWNEWS(ts, group), "\r\n".join)